@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from github import Github, GithubException
+
+from github_scheduler import GithubScheduler
+
+SECONDARY_MESSAGE = 'You have exceeded a secondary rate limit. ' \
+                    'Please wait a few minutes before you try again.'
+PRIMARY_MESSAGE = 'API rate limit exceeded for user.'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Serves the failures queued by the scenario being run, then the
+    # repository that was asked for
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def __send(self, status, body, headers):
+        data = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-RateLimit-Limit', '5000')
+        self.send_header('X-RateLimit-Remaining', str(headers.pop('remaining', 4999)))
+        self.send_header('X-RateLimit-Reset', str(int(time.time()) + headers.pop('reset', 3600)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+
+        with server.lock:
+            server.requests += 1
+            failure = server.failures.pop(0) if server.failures else None
+
+        if failure is not None:
+            status, message, headers = failure
+            self.__send(status, {'message': message}, dict(headers))
+            return
+
+        name = self.path.rstrip('/').split('/')[-1]
+        self.__send(200, {
+            'id': 1,
+            'name': name,
+            'full_name': f'org/{name}',
+            'url': f'http://{self.headers["Host"]}/repos/org/{name}',
+        }, {})
+
+
+# name, call type, failures served before succeeding, expected to succeed
+scenarios = [
+    ('secondary limit (403)', 'call',
+     [(403, SECONDARY_MESSAGE, {'Retry-After': '1'})] * 2, True),
+    ('secondary limit (429)', 'call',
+     [(429, SECONDARY_MESSAGE, {'Retry-After': '1'})] * 2, True),
+    ('secondary limit (429) in upload', 'call_upload',
+     [(429, SECONDARY_MESSAGE, {'Retry-After': '1'})], True),
+    ('too many requests (429) without Retry-After', 'call',
+     [(429, 'Too many requests', {})], True),
+    ('primary limit', 'call',
+     [(403, PRIMARY_MESSAGE, {'remaining': 0, 'reset': 2})], True),
+    ('server error (502)', 'call',
+     [(502, 'Bad gateway', {})] * 2, True),
+    ('server error (502) in upload', 'call_upload',
+     [(502, 'Bad gateway', {})], False),
+    ('not found (404)', 'call',
+     [(404, 'Not Found', {})], False),
+]
+
+
+def run(server, scenario, args):
+    name, call_type, failures, _ = scenario
+
+    with server.lock:
+        server.failures = list(failures)
+        server.requests = 0
+
+    # Retries of the client itself are disabled so that every failure
+    # reaches the scheduler
+    github = Github(base_url=f'http://127.0.0.1:{server.server_port}', retry=None)
+    scheduler = GithubScheduler(github, backoff=args.backoff, error_backoff=args.backoff,
+                                max_retries=args.max_retries)
+
+    start = time.perf_counter()
+    try:
+        getattr(scheduler, call_type)('get_repo', github.get_repo, 'org/device')
+        succeeded = True
+    except GithubException:
+        succeeded = False
+
+    return succeeded, server.requests, time.perf_counter() - start
+
+
+parser = argparse.ArgumentParser(
+    description='Run the GitHub scheduler against a local stand-in for the GitHub API')
+parser.add_argument('-b', '--backoff', help='Backoff of the scheduler in seconds',
+                    type=float, default=0.5)
+parser.add_argument('-r', '--max-retries', help='Retries of the scheduler', type=int, default=3)
+
+args = parser.parse_args()
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+server.lock = threading.Lock()
+server.failures = []
+server.requests = 0
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+failed = 0
+for scenario in scenarios:
+    succeeded, requests, elapsed = run(server, scenario, args)
+
+    expected = scenario[3]
+    result = 'ok' if succeeded == expected else 'FAILED'
+    if succeeded != expected:
+        failed += 1
+
+    outcome = 'succeeded' if succeeded else 'raised'
+    print(f'{scenario[0]:>45} | {outcome:>9} | {requests:2} requests | {elapsed:5.2f}s | {result}')
+
+server.shutdown()
+
+sys.exit(1 if failed else 0)
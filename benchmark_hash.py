@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import tempfile
+import time
+
+from file_utils import MIB, file_sha256, hash_modes
+
+size_units = {
+    'K': 1024,
+    'M': MIB,
+    'G': 1024 * MIB,
+}
+
+
+def parse_size(size):
+    unit = size[-1].upper()
+    if unit in size_units:
+        return int(float(size[:-1]) * size_units[unit])
+
+    return int(size)
+
+
+def create_file(path, size):
+    chunk = os.urandom(16 * MIB)
+
+    with open(path, 'wb') as file:
+        written = 0
+        while written < size:
+            n = min(len(chunk), size - written)
+            file.write(chunk[:n])
+            written += n
+
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def drop_file_cache(path):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    with open(path, 'rb') as file:
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def benchmark_mode(path, size, mode, repeat, cold):
+    best = None
+    sha256 = None
+
+    for _ in range(repeat):
+        if cold:
+            drop_file_cache(path)
+
+        start = time.perf_counter()
+        sha256 = file_sha256(path, mode)
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, size / MIB / best, sha256
+
+
+parser = argparse.ArgumentParser(description='Benchmark file hashing modes')
+parser.add_argument('-s', '--sizes', help='Sizes of the synthetic files', nargs='+',
+                    default=['100M', '1G', '4G'])
+parser.add_argument('-m', '--modes', help='Hash modes to compare', nargs='+',
+                    default=hash_modes, choices=hash_modes)
+parser.add_argument('-r', '--repeat', help='Runs per mode, the best one is reported',
+                    type=int, default=3)
+parser.add_argument('-d', '--dir', help='Directory to create the synthetic files in')
+parser.add_argument('--cold', help='Drop the file from the page cache before each run',
+                    action='store_true')
+
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory(dir=args.dir) as temp_dir:
+    for size_arg in args.sizes:
+        size = parse_size(size_arg)
+        path = os.path.join(temp_dir, f'hash-{size_arg}.bin')
+
+        print(f'Creating {size_arg} file {path}')
+        create_file(path, size)
+
+        sha256s = set()
+        for mode in args.modes:
+            elapsed, speed, sha256 = benchmark_mode(path, size, mode, args.repeat, args.cold)
+            sha256s.add(sha256)
+            print(f'{size_arg:>6} | {mode:>8} | {elapsed:8.3f}s | {speed:8.1f} MB/s')
+
+        if len(sha256s) != 1:
+            print(f'Hash modes disagree for {size_arg} file')
+
+        os.remove(path)
+        print()
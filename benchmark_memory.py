@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import argparse
+import gc
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from file_utils import MIB
+from publisher import BuildsJson
+
+
+def create_builds_json(path, devices_count, builds_count, files_count):
+    devices = {}
+
+    for i in range(builds_count):
+        device = f'device{i % devices_count}'
+        day = 1 + i // devices_count
+        raw_date = f'{2020 + day // 336}{1 + day // 28 % 12:02}{1 + day % 28:02}'
+        date = f'{raw_date[0:4]}-{raw_date[4:6]}-{raw_date[6:8]}'
+        version = f'{18 + i % 4}.{i % 2}'
+        name = f'lineage-{version}-{raw_date}-UNOFFICIAL-{device}'
+        build_path = f'/builds/{device}/{name}'
+
+        filenames = [f'{name}.zip'] + [f'image{j}.img' for j in range(files_count - 1)]
+        files = []
+        for filename in filenames:
+            files.append({
+                'path': f'{build_path}/{filename}',
+                'filename': filename,
+                'filepath': f'{device}/{name}/{filename}',
+                'sha256': os.urandom(32).hex(),
+                'size': 1000000 + i,
+            })
+
+        devices.setdefault(device, []).append({
+            'path': build_path,
+            'device': device,
+            'type': 'unofficial',
+            'version': version,
+            'date': date,
+            'datetime': 1577836800 + day * 86400,
+            'os_patch_level': None,
+            'files': files,
+        })
+
+    with open(path, 'w') as builds_json_file:
+        json.dump(devices, builds_json_file, indent=4)
+
+
+def measure(fn):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    result = fn()
+
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, current, peak, elapsed
+
+
+def load_raw(path):
+    with open(path, 'r') as builds_json_file:
+        return json.load(builds_json_file)
+
+
+def load_builds(path):
+    builds_json = BuildsJson(path)
+    with builds_json.reading() as devices:
+        # Keep the builds alive after the session is released
+        return dict(devices)
+
+
+parser = argparse.ArgumentParser(description='Benchmark memory used by the loaded builds index')
+parser.add_argument('-b', '--builds', help='Number of synthetic builds', type=int, default=20000)
+parser.add_argument('-d', '--devices', help='Number of synthetic devices', type=int, default=50)
+parser.add_argument('-f', '--files', help='Number of files per build', type=int, default=3)
+
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    path = os.path.join(temp_dir, 'builds.json')
+    create_builds_json(path, args.devices, args.builds, args.files)
+
+    print(f'Builds: {args.builds}, Devices: {args.devices}, Files per build: {args.files}, '
+          f'builds.json: {os.path.getsize(path) / MIB:.1f} MB')
+
+    for name, fn in [('json', load_raw), ('builds', load_builds)]:
+        result, current, peak, elapsed = measure(lambda: fn(path))
+        print(f'{name:>8} | {current / MIB:8.1f} MB retained | {peak / MIB:8.1f} MB peak | '
+              f'{current / args.builds:8.0f} B/build | {elapsed:6.2f}s')
+        del result
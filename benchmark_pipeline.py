@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+from file_utils import MIB
+from publisher import LocalPublisher
+
+
+class SimulatedUploadPublisher(LocalPublisher):
+    # Uploads take as long as they would over a link of the given speed
+    upload_speed = 0
+
+    def _upload_build(self, build):
+        size = sum(file.size for file in build.files)
+        time.sleep(size / self.upload_speed)
+        super()._upload_build(build)
+
+
+class SequentialPublisher(SimulatedUploadPublisher):
+    # All the builds of a device are hashed before publishing them
+    def _hash_builds(self, selected):
+        return list(super()._hash_builds(selected))
+
+
+def create_builds(builds_path, devices_count, builds_count, size):
+    for i in range(devices_count):
+        device = f'device{i}'
+        device_path = os.path.join(builds_path, device)
+        os.makedirs(device_path)
+
+        for j in range(builds_count):
+            name = f'lineage-21.0-202401{1 + j:02}-UNOFFICIAL-{device}.zip'
+            with open(os.path.join(device_path, name), 'wb') as build_file:
+                build_file.write(os.urandom(size))
+
+
+def run(cls, temp_dir, builds_path, args, queue_size):
+    builds_json_path = os.path.join(temp_dir, f'{cls.__name__}.json')
+    publisher = cls(builds_json_path, builds_path, [], [], 0,
+                    hash_workers=args.hash_workers, hash_queue_size=queue_size)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        publisher.index_builds()
+    return time.perf_counter() - start
+
+
+parser = argparse.ArgumentParser(description='Benchmark publishing builds while hashing them')
+parser.add_argument('-d', '--devices', help='Number of synthetic devices', type=int, default=3)
+parser.add_argument('-b', '--builds', help='Number of builds per device', type=int, default=4)
+parser.add_argument('-s', '--size', help='Size of each build in MiB', type=int, default=64)
+parser.add_argument('-u', '--upload-speed', help='Simulated upload speed in MiB/s',
+                    type=float, default=200)
+parser.add_argument('-w', '--hash-workers', help='Number of hash workers', type=int, default=2)
+parser.add_argument('-q', '--queue-size', help='Number of files hashed ahead', type=int, default=16)
+
+args = parser.parse_args()
+
+SimulatedUploadPublisher.upload_speed = args.upload_speed * MIB
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    builds_path = os.path.join(temp_dir, 'builds')
+    create_builds(builds_path, args.devices, args.builds, args.size * MIB)
+
+    total = args.devices * args.builds * args.size
+    print(f'Devices: {args.devices}, Builds per device: {args.builds}, Total: {total} MiB, '
+          f'Upload speed: {args.upload_speed:.0f} MiB/s, Hash workers: {args.hash_workers}')
+
+    # Hashing used to be queued for all the builds at once
+    for name, cls, queue_size in [('sequential', SequentialPublisher, 0),
+                                  ('pipeline', SimulatedUploadPublisher, args.queue_size)]:
+        elapsed = run(cls, temp_dir, builds_path, args, queue_size)
+        print(f'{name:>10} | {elapsed:6.2f}s | {total / elapsed:8.1f} MiB/s')
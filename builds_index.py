@@ -0,0 +1,157 @@
+import json
+import os
+
+from bisect import bisect_left, insort
+
+from file_utils import write_file_atomic
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+class BuildsIndex:
+    def __init__(self, path):
+        self.__path = path
+        self.__versions = None
+        self.__dates = None
+        self.__dirty = False
+        self.__sources = None
+        self.spans = None
+        self.fingerprints = None
+
+    @property
+    def loaded(self):
+        return self.__dates is not None
+
+    def load(self, source_paths, devices_fn):
+        # The index is only trusted if the files it was built from did not
+        # change since then, otherwise it is built again from the builds
+        # of each device returned by devices_fn
+        sources = {path: _stat_key(path) for path in source_paths}
+
+        try:
+            with open(self.__path, 'r') as index_file:
+                serialization = json.load(index_file)
+        except (IOError, ValueError):
+            serialization = None
+
+        if serialization is not None and serialization.get('sources') == sources:
+            try:
+                self.__versions = serialization['versions']
+                self.__dates = serialization['dates']
+                self.spans = serialization['spans']
+                self.fingerprints = serialization['fingerprints']
+                self.__sources = sources
+                self.__dirty = False
+                return
+            except KeyError:
+                pass
+
+        print(f'Builds index {self.__path} is out of date, rebuilding')
+
+        self.__versions = {}
+        self.__dates = []
+        self.spans = {}
+        self.fingerprints = {}
+        for device, span, entries in devices_fn():
+            if span is not None:
+                self.spans[device] = span
+
+            for name, version, date_time in entries:
+                self.__versions.setdefault(version, []).append([device, name])
+                self.__dates.append([date_time, device, name])
+        self.__dates.sort()
+        self.__dirty = True
+
+    def save(self, source_paths):
+        # The files the index was built from can be written without the
+        # index changing, it still has to be saved to match them again
+        sources = {path: _stat_key(path) for path in source_paths}
+        if not self.__dirty and sources == self.__sources:
+            return
+
+        serialization = {
+            'sources': sources,
+            'versions': self.__versions,
+            'dates': self.__dates,
+            'spans': self.spans,
+            'fingerprints': self.fingerprints,
+        }
+
+        write_file_atomic(self.__path, json.dumps(serialization, separators=(',', ':')))
+        self.__sources = sources
+        self.__dirty = False
+
+    def unload(self):
+        self.__versions = None
+        self.__dates = None
+        self.__dirty = False
+        self.__sources = None
+        self.spans = None
+        self.fingerprints = None
+
+    def set_spans(self, spans):
+        if spans != self.spans:
+            self.spans = spans
+            self.__dirty = True
+
+    def set_fingerprint(self, device, fingerprint):
+        if self.fingerprints.get(device) == fingerprint:
+            return
+
+        if fingerprint is None:
+            del self.fingerprints[device]
+        else:
+            self.fingerprints[device] = fingerprint
+        self.__dirty = True
+
+    def add(self, build):
+        self.__versions.setdefault(build.version, []).append([build.device, build.name])
+        insort(self.__dates, [build.date_time, build.device, build.name])
+        self.__dirty = True
+
+    def remove(self, build):
+        entries = self.__versions.get(build.version)
+        entry = [build.device, build.name]
+        if entries is not None and entry in entries:
+            entries.remove(entry)
+            if not entries:
+                del self.__versions[build.version]
+
+        date_entry = [build.date_time, build.device, build.name]
+        index = bisect_left(self.__dates, date_entry)
+        if index < len(self.__dates) and self.__dates[index] == date_entry:
+            del self.__dates[index]
+
+        self.__dirty = True
+
+    def find(self, version=None, min_date_time=None, max_date_time=None):
+        # Returns the (device, name) pairs of the matching builds, or None
+        # if there is nothing to filter on
+        candidates = None
+
+        if version is not None:
+            candidates = {(device, name) for device, name in self.__versions.get(version, ())}
+
+        if min_date_time is not None or max_date_time is not None:
+            start = 0
+            if min_date_time is not None:
+                start = bisect_left(self.__dates, [min_date_time])
+
+            end = len(self.__dates)
+            if max_date_time is not None:
+                end = bisect_left(self.__dates, [max_date_time])
+
+            in_range = {(device, name) for _, device, name in self.__dates[start:end]}
+            if candidates is None:
+                candidates = in_range
+            else:
+                candidates &= in_range
+
+        return candidates
@@ -1,6 +1,9 @@
 import json
+import os
 import sys
 
+from file_utils import hash_modes, sidecar_modes
+
 
 class Config:
     def __init__(self, config_path):
@@ -14,7 +17,32 @@ class Config:
         self.builds_path = config.get('builds_path')
         self.ignored_versions = config.get('ignored_versions', [])
         self.builds_json_path = config.get('builds_json_path')
+        self.hash_cache_path = config.get(
+            'hash_cache_path',
+            os.path.join(os.path.dirname(self.builds_json_path), 'hash_cache.json'))
+        self.builds_shards_path = config.get('builds_shards_path')
+        self.builds_index_path = config.get(
+            'builds_index_path',
+            os.path.join(os.path.dirname(self.builds_json_path), 'builds_index.json'))
+        self.builds_json_compact = config.get('builds_json_compact', False)
         self.builds_limit = config.get('builds_limit', 0)
+        self.hash_workers = config.get('hash_workers', 4)
+        self.hash_queue_size = config.get('hash_queue_size', 16)
+        self.check_workers = config.get('check_workers', 8)
+        self.delete_workers = config.get('delete_workers', 8)
+        self.hash_mode = config.get('hash_mode', 'readinto')
+        if self.hash_mode not in hash_modes:
+            print(f'invalid hash_mode {self.hash_mode}, must be one of {", ".join(hash_modes)}')
+            sys.exit(-1)
+        self.sidecar_mode = config.get('sidecar_mode', 'ignore')
+        if self.sidecar_mode not in sidecar_modes:
+            print(f'invalid sidecar_mode {self.sidecar_mode}, must be one of {", ".join(sidecar_modes)}')
+            sys.exit(-1)
         self.github_token = config.get('github_token', '')
         self.github_organization = config.get('github_organization', '')
+        self.upload_workers = config.get('upload_workers', 4)
+        self.upload_retries = config.get('upload_retries', 3)
+        self.upload_state_path = config.get(
+            'upload_state_path',
+            os.path.join(os.path.dirname(self.builds_json_path), 'upload_state.json'))
         self.blacklisted_devices = config.get('blacklisted_devices', [])
@@ -1,7 +1,12 @@
 import hashlib
+import mmap
 import os
 import shutil
+import stat
 import pathlib
+import threading
+
+from metrics import metrics
 
 
 def is_dir(path):
@@ -29,18 +34,195 @@ def file_size(path):
     return os.path.getsize(path)
 
 
-def file_sha256(path):
-    sha256 = hashlib.sha256()
-    b = bytearray(128 * 1024)
+class PathEntry:
+    # Same interface as os.DirEntry, for paths that were not found while
+    # scanning their parent directory. The stat result is cached the same
+    # way.
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.__stat = None
+
+    def stat(self):
+        if self.__stat is None:
+            self.__stat = os.stat(self.path)
+        return self.__stat
+
+    def __is_mode(self, check_fn):
+        try:
+            return check_fn(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        return self.__is_mode(stat.S_ISREG)
+
+    def is_dir(self):
+        return self.__is_mode(stat.S_ISDIR)
+
+
+MIB = 1024 * 1024
+
+hash_modes = [
+    'readinto',
+    'adaptive',
+    'mmap',
+]
+
+
+def _fadvise(fd, offset, length, advice_name):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    advice = getattr(os, advice_name)
+    os.posix_fadvise(fd, offset, length, advice)
+
+
+def _adaptive_block_size(size):
+    # Scale the block size with the file size, from 1 MiB for small
+    # files up to 16 MiB for multi-GB images
+    block_size = MIB
+    while block_size < 16 * MIB and block_size * 256 < size:
+        block_size *= 2
+    return block_size
+
+
+def _file_sha256_readinto(sha256, file, block_size, drop_cache):
+    b = bytearray(block_size)
     mv = memoryview(b)
 
-    with open(path, 'rb', buffering=0) as file:
-        for index in iter(lambda: file.readinto(mv), 0):
-            sha256.update(mv[:index])
+    # Drop the pages that were already hashed from the page cache every
+    # few blocks so that hashing does not evict more useful data
+    drop_size = max(block_size, 64 * MIB)
+    offset = 0
+    dropped = 0
+
+    for index in iter(lambda: file.readinto(mv), 0):
+        sha256.update(mv[:index])
+        offset += index
+
+        if drop_cache and offset - dropped >= drop_size:
+            _fadvise(file.fileno(), dropped, offset - dropped,
+                     'POSIX_FADV_DONTNEED')
+            dropped = offset
+
+
+def _file_sha256_mmap(sha256, file, size):
+    if size == 0:
+        return
+
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+
+        block_size = 16 * MIB
+        with memoryview(mm) as mv:
+            for offset in range(0, size, block_size):
+                sha256.update(mv[offset:offset + block_size])
+
+
+def file_sha256(path, mode='readinto'):
+    if mode not in hash_modes:
+        raise ValueError(f'{mode} is not a valid hash mode')
+
+    sha256 = hashlib.sha256()
+
+    with metrics.time('hash_seconds'), open(path, 'rb', buffering=0) as file:
+        fd = file.fileno()
+        size = os.fstat(fd).st_size
+        metrics.add('hashed_bytes', size)
+        metrics.add('hashed_files')
+
+        if mode == 'readinto':
+            _file_sha256_readinto(sha256, file, 128 * 1024, False)
+            return sha256.hexdigest()
+
+        _fadvise(fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+
+        if mode == 'adaptive':
+            block_size = _adaptive_block_size(size)
+            _file_sha256_readinto(sha256, file, block_size, True)
+        else:
+            _file_sha256_mmap(sha256, file, size)
+
+        _fadvise(fd, 0, 0, 'POSIX_FADV_DONTNEED')
 
     return sha256.hexdigest()
 
 
+sidecar_modes = [
+    'ignore',
+    'trust',
+    'verify',
+]
+
+# Only sha256sum sidecars hold a digest that can stand in for hashing
+sidecar_extensions = [
+    '.sha256sum',
+    '.sha256',
+]
+
+
+def sidecar_target_filename(filename):
+    for ext in sidecar_extensions:
+        if filename.endswith(ext) and len(filename) > len(ext):
+            return filename[:-len(ext)]
+
+    return None
+
+
+def read_sidecar_sha256(sidecar_path, filename):
+    # sha256sum output, the digest optionally followed by the name of
+    # the file it was computed for, marked with * in binary mode
+    try:
+        with open(sidecar_path, 'r') as sidecar_file:
+            line = sidecar_file.readline()
+    except (IOError, UnicodeDecodeError):
+        return None
+
+    parts = line.strip().split(None, 1)
+    if not parts:
+        return None
+
+    sha256 = parts[0].lower()
+    if len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256):
+        return None
+
+    if len(parts) == 2 and path_filename(parts[1].lstrip('*')) != filename:
+        return None
+
+    return sha256
+
+
+def write_file_atomic(path, data):
+    # Write into a temporary file next to the target and rename it over
+    # the target, readers either see the old or the new content
+    dir_path = os.path.dirname(path) or '.'
+    temp_path = path_join(dir_path, f'.{path_filename(path)}.'
+                          f'{os.getpid()}.{threading.get_ident()}.tmp')
+
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    dir_fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
 def path_relative(base, path):
     return os.path.relpath(path, base)
 
@@ -53,29 +235,54 @@ def path_join(base_path, path):
     return os.path.join(base_path, path)
 
 
-def _path_files(path, check_fn, descending):
-    if not is_dir(path):
+def _path_entries(path, check_fn, descending):
+    # The type of the entries is usually known from reading the directory
+    # itself, without having to stat each of them
+    try:
+        with os.scandir(path) as it:
+            entries = [f for f in it if check_fn(f)]
+    except (FileNotFoundError, NotADirectoryError):
         raise ValueError(f'{path} is not a directory')
 
-    paths = [f for f in os.scandir(path) if check_fn(f.path)]
+    entries.sort(key=lambda f: f.name.lower(), reverse=descending)
+
+    return entries
+
 
-    paths.sort(key=lambda f: f.name.lower(), reverse=descending)
+def _is_entry_file(entry):
+    return entry.is_file()
 
-    paths = [f.path for f in paths]
 
-    return paths
+def _is_entry_dir(entry):
+    return entry.is_dir()
+
+
+def _is_entry_dir_or_file(entry):
+    return entry.is_dir() or entry.is_file()
+
+
+def path_file_entries(path, descending=False):
+    return _path_entries(path, _is_entry_file, descending)
+
+
+def path_file_or_dir_entries(path, descending=False):
+    return _path_entries(path, _is_entry_dir_or_file, descending)
+
+
+def path_dir_entries(path, descending=False):
+    return _path_entries(path, _is_entry_dir, descending)
 
 
 def path_files(path, descending=False):
-    return _path_files(path, is_file, descending)
+    return [f.path for f in path_file_entries(path, descending)]
 
 
 def path_files_or_dirs(path, descending=False):
-    return _path_files(path, is_dir_or_file, descending)
+    return [f.path for f in path_file_or_dir_entries(path, descending)]
 
 
 def path_dirs(path, descending=False):
-    return _path_files(path, is_dir, descending)
+    return [f.path for f in path_dir_entries(path, descending)]
 
 
 valid_extensions = [
@@ -117,11 +324,8 @@ def extract_filename_parts(filename):
 
 # lineage-17.1-20200422-UNOFFICIAL-bardock.zip
 # lineage-21.0-20240622-UNOFFICIAL-arm64-gsi.img
-def is_build(path):
-    if not is_file(path):
-        return False
-
-    name, ext = extract_path_name_valid_ext(path)
+def is_build_filename(filename):
+    name, ext = extract_path_name_valid_ext(filename)
     if not ext:
         return False
 
@@ -133,3 +337,11 @@ def is_build(path):
         return False
 
     return True
+
+
+def is_build_entry(entry):
+    return is_build_filename(entry.name) and entry.is_file()
+
+
+def is_build(path):
+    return is_build_entry(PathEntry(path))
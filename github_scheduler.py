@@ -0,0 +1,193 @@
+import random
+import threading
+import time
+
+from github import GithubException, RateLimitExceededException
+from github.Requester import Requester
+
+from metrics import metrics
+
+
+class GithubScheduler:
+    def __init__(self, github, reserve=10, pace_ratio=0.1,
+                 max_retries=8, backoff=30, error_backoff=2, max_backoff=600):
+        self.__requesters = []
+        self.__reserve = reserve
+        self.__pace_ratio = pace_ratio
+        self.__max_retries = max_retries
+        self.__backoff = backoff
+        self.__error_backoff = error_backoff
+        self.__max_backoff = max_backoff
+
+        # Requests other than asset uploads share a single connection
+        # inside PyGithub which is not thread safe
+        self.__lock = threading.Lock()
+        self.__stats_lock = threading.Lock()
+
+        self.__last_call_time = 0
+        self.__last_remaining = None
+        self.__remaining = -1
+        self.__limit = -1
+        self.__reset_time = 0
+        self.calls = {}
+        self.used = 0
+        self.waited = 0
+
+        self.register(github)
+
+    def register(self, github):
+        # Rate limit headers of every response are tracked by the
+        # requester of each client, the lazy user object gives access to
+        # it without making a request
+        with self.__stats_lock:
+            self.__requesters.append(github.get_user()._requester)
+
+    def __read_rate_limit(self):
+        # All clients share the budget of the same token, use the most
+        # recent values seen by any of them
+        remaining, limit, reset_time = -1, -1, 0
+        for requester in self.__requesters:
+            requester_remaining, requester_limit = requester.rate_limiting
+            requester_reset_time = requester.rate_limiting_resettime
+            if requester_remaining < 0:
+                continue
+
+            if requester_reset_time > reset_time or \
+                    (requester_reset_time == reset_time and requester_remaining < remaining):
+                remaining = requester_remaining
+                limit = requester_limit
+                reset_time = requester_reset_time
+
+        return remaining, limit, reset_time
+
+    def __sleep(self, delay, reason):
+        print(f'{reason}, waiting {delay:.0f}s')
+        time.sleep(delay)
+
+        with self.__stats_lock:
+            self.waited += delay
+        metrics.add('github_api_waited_seconds', delay)
+
+    def __pace(self):
+        with self.__stats_lock:
+            remaining, limit = self.__remaining, self.__limit
+            reset_time = self.__reset_time
+
+        if remaining < 0:
+            return
+
+        now = time.time()
+        reset_delay = reset_time - now
+
+        if remaining <= self.__reserve:
+            if reset_delay > 0:
+                self.__sleep(reset_delay + 1, f'GitHub rate limit almost exhausted ({remaining} left)')
+            return
+
+        # Spread the requests that are left evenly until the reset once
+        # the remaining budget gets low
+        if remaining < limit * self.__pace_ratio and reset_delay > 0:
+            interval = reset_delay / remaining
+            delay = self.__last_call_time + interval - now
+            if delay > 0:
+                time.sleep(delay)
+                with self.__stats_lock:
+                    self.waited += delay
+                metrics.add('github_api_waited_seconds', delay)
+
+    def __account(self, name):
+        with self.__stats_lock:
+            remaining, limit, reset_time = self.__read_rate_limit()
+
+            self.__last_call_time = time.time()
+            self.calls[name] = self.calls.get(name, 0) + 1
+            metrics.add('github_api_calls', endpoint=name)
+
+            if remaining < 0:
+                return
+
+            self.__remaining = remaining
+            self.__limit = limit
+            self.__reset_time = reset_time
+
+            if self.__last_remaining is not None:
+                if remaining <= self.__last_remaining:
+                    self.used += self.__last_remaining - remaining
+                else:
+                    # The rate limit has been reset in the meantime
+                    self.used += limit - remaining
+
+            self.__last_remaining = remaining
+
+    def __backoff_delay(self, e, attempt, backoff):
+        headers = e.headers or {}
+        retry_after = headers.get('retry-after')
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after) + random.uniform(0, 1)
+
+        delay = min(self.__max_backoff, backoff * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    def __call(self, name, fn, args, kwargs, retry_errors):
+        attempt = 0
+
+        while True:
+            self.__pace()
+
+            try:
+                return fn(*args, **kwargs)
+            except GithubException as e:
+                message = e.data.get('message', '') if isinstance(e.data, dict) else ''
+                rate_limited = isinstance(e, RateLimitExceededException)
+
+                if rate_limited and Requester.isPrimaryRateLimitError(message):
+                    with self.__stats_lock:
+                        reset_time = self.__reset_time
+                    reset_delay = reset_time - time.time()
+                    self.__sleep(max(reset_delay, 0) + 1, f'GitHub rate limit exceeded in {name}')
+                    continue
+
+                # Secondary rate limits can also be served as 429, which
+                # PyGithub does not turn into RateLimitExceededException
+                if not rate_limited and e.status != 429:
+                    if not retry_errors or e.status < 500 \
+                            or attempt == self.__max_retries:
+                        raise
+
+                    delay = self.__backoff_delay(e, attempt, self.__error_backoff)
+                    attempt += 1
+                    self.__sleep(delay, f'GitHub server error {e.status} in {name} ({attempt}/{self.__max_retries})')
+                    continue
+
+                if attempt == self.__max_retries:
+                    raise
+
+                delay = self.__backoff_delay(e, attempt, self.__backoff)
+                attempt += 1
+                self.__sleep(delay, f'GitHub secondary rate limit hit in {name} ({attempt}/{self.__max_retries})')
+            finally:
+                self.__account(name)
+
+    def call(self, name, fn, *args, **kwargs):
+        with self.__lock:
+            return self.__call(name, fn, args, kwargs, True)
+
+    def call_concurrent(self, name, fn, *args, **kwargs):
+        # For requests made through a client that is only used by the
+        # calling thread
+        return self.__call(name, fn, args, kwargs, True)
+
+    def call_upload(self, name, fn, *args, **kwargs):
+        # Uploads use their own connection and can run concurrently, a
+        # failed upload can leave a partial asset behind so server errors
+        # are left to the caller to handle
+        return self.__call(name, fn, args, kwargs, False)
+
+    def print_stats(self):
+        remaining, limit = self.__remaining, self.__limit
+        requests = sum(self.calls.values())
+        print(f'GitHub API | Requests: {requests}, Used: {self.used}, '
+              f'Remaining: {remaining}/{limit}, Waited: {self.waited:.0f}s')
+
+        for name, count in sorted(self.calls.items()):
+            print(f'GitHub API | {name}: {count}')
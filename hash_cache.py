@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+
+from file_utils import file_sha256, path_join, write_file_atomic
+from metrics import metrics
+
+
+_hash_caches = {}
+
+
+class HashCacheStats:
+    # Hash caches are shared by publishers, each of them keeps its own
+    # stats
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def print_stats(self):
+        if self.hits == 0 and self.misses == 0:
+            return
+
+        print(f'Hash cache | Hits: {self.hits}, Misses: {self.misses}')
+
+        # Every run only prints its own stats
+        self.hits = 0
+        self.misses = 0
+
+
+class HashCache:
+    def __init__(self, path, rehash=False, hash_mode='readinto'):
+        self.__path = path
+        self.__rehash = rehash
+        self.__hash_mode = hash_mode
+        self.__entries = None
+        self.__depth = 0
+        self.__dirty = False
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, path, *args):
+        if path is None:
+            return cls(path, *args)
+
+        key = os.path.realpath(path)
+        hash_cache = _hash_caches.get(key)
+        if hash_cache is None:
+            hash_cache = cls(path, *args)
+            _hash_caches[key] = hash_cache
+        return hash_cache
+
+    @staticmethod
+    def _stat_key(stat):
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def __load(self):
+        if self.__path is None:
+            return
+
+        try:
+            with open(self.__path, 'r') as hash_cache_file:
+                entries = json.load(hash_cache_file)
+        except (IOError, ValueError):
+            entries = {}
+
+        self.__entries = entries
+        self.__dirty = False
+
+    def __save(self):
+        if self.__entries is None:
+            return
+
+        if not self.__dirty:
+            return
+
+        write_file_atomic(self.__path, json.dumps(self.__entries))
+        self.__dirty = False
+
+    def __enter__(self):
+        # The cache file is only loaded once the first file is hashed,
+        # publishers running in parallel can share the cache
+        with self.__lock:
+            self.__depth += 1
+
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        with self.__lock:
+            self.__depth -= 1
+
+            if self.__depth == 0:
+                self.__save()
+                self.__entries = None
+
+        return False
+
+    def flush(self):
+        # Write the hashes computed so far while keeping the cache loaded
+        with self.__lock:
+            self.__save()
+
+    def forget_missing(self, dir_path, paths, kept_dir_paths=()):
+        # Drop the entries of the files under a directory that were not
+        # found when listing it, without looking each of them up again,
+        # the entries under the directories that were not listed are kept
+        prefix = path_join(dir_path, '')
+        kept_prefixes = tuple(path_join(kept_dir_path, '') for kept_dir_path in kept_dir_paths)
+
+        with self.__lock:
+            if self.__entries is None and self.__depth != 0:
+                self.__load()
+
+            if self.__entries is None:
+                return
+
+            missing_paths = [path for path in self.__entries
+                             if path.startswith(prefix) and path not in paths
+                             and not path.startswith(kept_prefixes)]
+            for path in missing_paths:
+                del self.__entries[path]
+
+            if missing_paths:
+                self.__dirty = True
+
+    def get(self, path, stat=None, stats=None):
+        # Only look up the hash of the file, without hashing it
+        if stat is None:
+            stat = os.stat(path)
+        key = self._stat_key(stat)
+
+        with self.__lock:
+            if self.__entries is None and self.__depth != 0:
+                self.__load()
+
+            if self.__entries is None or self.__rehash:
+                return None
+
+            entry = self.__entries.get(path)
+            if entry is None or entry['stat'] != key:
+                return None
+
+            if stats is not None:
+                stats.hits += 1
+            metrics.add('hash_cache_hits')
+            return entry['sha256']
+
+    def sha256(self, path, stat=None, stats=None):
+        if stat is None:
+            stat = os.stat(path)
+        key = self._stat_key(stat)
+
+        with self.__lock:
+            if self.__entries is None and self.__depth != 0:
+                self.__load()
+
+            entry = None
+            if self.__entries is not None and not self.__rehash:
+                entry = self.__entries.get(path)
+
+            if entry is not None and entry['stat'] == key:
+                if stats is not None:
+                    stats.hits += 1
+                metrics.add('hash_cache_hits')
+                return entry['sha256']
+
+            if stats is not None:
+                stats.misses += 1
+            metrics.add('hash_cache_misses')
+
+        sha256 = file_sha256(path, self.__hash_mode)
+
+        with self.__lock:
+            if self.__entries is not None:
+                self.__entries[path] = {
+                    'stat': key,
+                    'sha256': sha256,
+                }
+                self.__dirty = True
+
+        return sha256
@@ -0,0 +1,199 @@
+import os
+
+from collections import deque
+
+from file_utils import path_filename, read_sidecar_sha256, sidecar_target_filename
+from hash_cache import HashCacheStats
+from metrics import metrics
+from output import ThreadPoolExecutor
+
+
+class Hasher:
+    def __init__(self, hash_cache, workers, sidecar_mode='ignore', queue_size=0):
+        self.__hash_cache = hash_cache
+        self.__workers = workers
+        self.__sidecar_mode = sidecar_mode
+        self.__queue_size = queue_size
+        self.__executor = None
+        self.__verify_executor = None
+        self.__futures = {}
+        self.__queue = deque()
+        self.__running = 0
+        self.__sidecars = {}
+        self.__mismatches = {}
+        self.__depth = 0
+        self.hash_cache_stats = HashCacheStats()
+        self.sidecar_hits = 0
+        self.sidecar_mismatches = 0
+
+    def __enter__(self):
+        if self.__depth == 0 and self.__workers > 1:
+            self.__executor = ThreadPoolExecutor(self.__workers)
+
+        self.__depth += 1
+        self.__hash_cache.__enter__()
+
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if self.__depth == 1 and self.__verify_executor is not None:
+            # The verified hashes have to end up in the hash cache
+            self.__verify_executor.shutdown()
+            self.__verify_executor = None
+
+        self.__hash_cache.__exit__(exception_type, exception_value, traceback)
+        self.__depth -= 1
+
+        if self.__depth == 0 and self.__executor is not None:
+            self.__executor.shutdown(cancel_futures=True)
+            self.__executor = None
+            self.__futures = {}
+            self.__queue = deque()
+            self.__running = 0
+
+        if self.__depth == 0:
+            self.__sidecars = {}
+
+        return False
+
+    def flush(self):
+        self.__hash_cache.flush()
+
+    def reset(self):
+        # Files can change before the next job, the hashes prefetched but
+        # not used by a job cannot be used by the next one
+        for future in self.__futures.values():
+            if future is not None:
+                future.cancel()
+
+        self.__futures = {}
+        self.__queue = deque()
+        self.__running = 0
+        self.__sidecars = {}
+
+    def add_sidecars(self, entries):
+        # Checksum sidecars are found next to the files they belong to,
+        # in the same directory listing
+        if self.__sidecar_mode == 'ignore':
+            return
+
+        paths = {entry.name: entry.path for entry in entries}
+        for entry in entries:
+            target = sidecar_target_filename(entry.name)
+            if target is not None and target in paths:
+                self.__sidecars[paths[target]] = entry.path
+
+    def prefetch(self, entries):
+        if self.__executor is None:
+            return
+
+        for entry in entries:
+            if entry.path in self.__futures:
+                continue
+
+            # Files with checksum sidecars are not hashed up front
+            if entry.path in self.__sidecars:
+                continue
+
+            self.__futures[entry.path] = None
+            self.__queue.append(entry)
+
+        self.__submit_queued()
+
+    def __submit_queued(self):
+        # Only hash up to queue_size files ahead of the ones being used,
+        # the others wait in the queue
+        while self.__queue:
+            if self.__queue_size and self.__running >= self.__queue_size:
+                break
+
+            entry = self.__queue.popleft()
+
+            # Files that were needed before their turn came are hashed
+            # right away
+            if entry.path not in self.__futures:
+                continue
+
+            self.__futures[entry.path] = self.__executor.submit(
+                self.__hash_entry, entry)
+            self.__running += 1
+
+    def __hash_entry(self, entry):
+        return self.__hash_cache.sha256(entry.path, entry.stat(), self.hash_cache_stats)
+
+    def __verify(self, path, stat, sidecar_path, sha256):
+        actual_sha256 = self.__hash_cache.sha256(path, stat, self.hash_cache_stats)
+        if actual_sha256 == sha256:
+            return
+
+        # The hash cache now holds the right hash, which is used instead
+        # of the sidecar from now on
+        self.__mismatches[path] = actual_sha256
+        self.sidecar_mismatches += 1
+        metrics.add('sidecar_mismatches')
+        print(f'Checksum sidecar {sidecar_path} does not match {path}')
+
+    def __sidecar_sha256(self, path, stat):
+        sidecar_path = self.__sidecars.get(path)
+        if sidecar_path is None:
+            return None
+
+        if stat is None:
+            stat = os.stat(path)
+
+        if self.__sidecar_mode == 'verify':
+            sha256 = self.__hash_cache.get(path, stat, self.hash_cache_stats)
+            if sha256 is not None:
+                return sha256
+
+        sha256 = read_sidecar_sha256(sidecar_path, path_filename(path))
+        if sha256 is None:
+            print(f'Checksum sidecar {sidecar_path} is not valid, hashing {path}')
+            return None
+
+        self.sidecar_hits += 1
+        metrics.add('sidecar_hits')
+
+        if self.__sidecar_mode == 'verify':
+            if self.__verify_executor is None:
+                self.__verify_executor = ThreadPoolExecutor(1)
+
+            self.__verify_executor.submit(self.__verify, path, stat, sidecar_path, sha256)
+
+        return sha256
+
+    def verified_mismatches(self):
+        # Wait for the checksum sidecars to be verified, and return the
+        # right hashes of the files whose sidecars did not match
+        if self.__verify_executor is not None:
+            self.__verify_executor.shutdown()
+            self.__verify_executor = None
+
+        mismatches = self.__mismatches
+        self.__mismatches = {}
+        return mismatches
+
+    def sha256(self, path, stat=None):
+        future = self.__futures.pop(path, None)
+        if future is not None:
+            self.__running -= 1
+            self.__submit_queued()
+            return future.result()
+
+        sha256 = self.__sidecar_sha256(path, stat)
+        if sha256 is not None:
+            return sha256
+
+        return self.__hash_cache.sha256(path, stat, self.hash_cache_stats)
+
+    def print_stats(self):
+        self.hash_cache_stats.print_stats()
+
+        if self.sidecar_hits == 0:
+            return
+
+        print(f'Checksum sidecars | Used: {self.sidecar_hits}, '
+              f'Mismatched: {self.sidecar_mismatches}')
+
+        self.sidecar_hits = 0
+        self.sidecar_mismatches = 0
@@ -0,0 +1,105 @@
+import json
+import re
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def _skip_whitespace(raw, index):
+    return _whitespace.match(raw, index).end()
+
+
+def _expect(raw, index, c):
+    if index >= len(raw) or raw[index] != c:
+        raise ValueError(f'Expecting {c!r} at char {index}')
+
+    return _skip_whitespace(raw, index + 1)
+
+
+def iter_object_entries(raw, keys=None):
+    # Decode the values of a top level JSON object one at a time, so that
+    # only the values of the requested keys are kept around, together
+    # with the span of each value as byte offsets inside the UTF-8
+    # encoding of the raw string, which can be used to seek in the file
+    is_ascii = raw.isascii()
+    char_offset = 0
+    byte_offset = 0
+
+    def to_byte_offset(offset):
+        nonlocal char_offset, byte_offset
+
+        if is_ascii:
+            return offset
+
+        # Spans are found in order, only encode what is after the last one
+        byte_offset += len(raw[char_offset:offset].encode())
+        char_offset = offset
+        return byte_offset
+
+    index = _skip_whitespace(raw, 0)
+    index = _expect(raw, index, '{')
+
+    if raw.startswith('}', index):
+        return
+
+    while True:
+        key, index = _decoder.raw_decode(raw, index)
+        index = _skip_whitespace(raw, index)
+        index = _expect(raw, index, ':')
+
+        start = index
+        value, index = _decoder.raw_decode(raw, index)
+        if keys is None or key in keys:
+            yield key, value, (to_byte_offset(start), to_byte_offset(index))
+
+        index = _skip_whitespace(raw, index)
+        if raw.startswith('}', index):
+            return
+
+        index = _expect(raw, index, ',')
+
+
+def dumps_object_entries(serialization, indent=None):
+    # Same output as json.dumps for a dict with the default separators
+    # when indented, or the most compact ones otherwise, also returns the
+    # span of each value as byte offsets inside the output, which is
+    # always ASCII since json.dumps escapes all other characters
+    if not serialization:
+        return '{}', {}
+
+    if indent is None:
+        prefix, key_separator, item_separator, suffix = '{', ':', ',', '}'
+        newline = None
+    else:
+        newline = '\n' + ' ' * indent
+        prefix, key_separator, item_separator, suffix = \
+            '{' + newline, ': ', ',' + newline, '\n}'
+
+    parts = [prefix]
+    position = len(prefix)
+    spans = {}
+
+    for key, value in serialization.items():
+        if len(parts) != 1:
+            parts.append(item_separator)
+            position += len(item_separator)
+
+        key_raw = json.dumps(key) + key_separator
+
+        if indent is None:
+            value_raw = json.dumps(value, separators=(',', ':'))
+        else:
+            # Strings cannot contain raw newlines, only the indentation
+            # of nested values has to be shifted
+            value_raw = json.dumps(value, indent=indent).replace('\n', newline)
+
+        position += len(key_raw)
+        spans[key] = (position, position + len(value_raw))
+        position += len(value_raw)
+
+        parts.append(key_raw)
+        parts.append(value_raw)
+
+    parts.append(suffix)
+
+    return ''.join(parts), spans
@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+
+metrics_formats = [
+    'json',
+    'prometheus',
+]
+
+PROMETHEUS_PREFIX = 'builds_publisher_'
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    # Counters and durations collected during a run, identified by their
+    # name and labels, values with the same name and labels are summed up
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__values = {}
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + value
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, **labels)
+
+    def __items(self):
+        with self.__lock:
+            values = dict(self.__values)
+
+        # Hashing speed of a single hash worker
+        hashed_bytes = values.get(('hashed_bytes', ()))
+        hash_seconds = values.get(('hash_seconds', ()))
+        if hashed_bytes and hash_seconds:
+            values[('hash_bytes_per_second', ())] = hashed_bytes / hash_seconds
+
+        return sorted(values.items())
+
+    def to_json(self):
+        serialization = {}
+
+        for (name, labels), value in self.__items():
+            if labels:
+                serialization.setdefault(name, []).append({**dict(labels), 'value': value})
+            else:
+                serialization[name] = value
+
+        return json.dumps(serialization, indent=4)
+
+    def to_prometheus(self):
+        lines = []
+
+        last_name = None
+        for (name, labels), value in self.__items():
+            metric = PROMETHEUS_PREFIX + name
+
+            # Every run overwrites the values of the previous one
+            if name != last_name:
+                lines.append(f'# TYPE {metric} gauge')
+                last_name = name
+
+            if labels:
+                formatted_labels = ','.join(f'{key}="{_escape_label_value(value)}"'
+                                            for key, value in labels)
+                metric = f'{metric}{{{formatted_labels}}}'
+
+            lines.append(f'{metric} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def format(self, fmt):
+        if fmt == 'prometheus':
+            return self.to_prometheus()
+
+        return self.to_json()
+
+
+metrics = Metrics()
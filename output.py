@@ -0,0 +1,54 @@
+import concurrent.futures
+import threading
+
+_local = threading.local()
+
+
+def get_output_prefix():
+    return getattr(_local, 'prefix', None)
+
+
+def set_output_prefix(prefix):
+    _local.prefix = prefix
+
+
+class PrefixedOutput:
+    # Every line printed by a thread gets the prefix set by that thread,
+    # lines printed by different threads are never mixed up
+    def __init__(self, stream):
+        self.__stream = stream
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def write(self, s):
+        prefix = get_output_prefix()
+        if prefix is None:
+            with self.__lock:
+                self.__stream.write(s)
+            return len(s)
+
+        *lines, buffer = (getattr(self.__local, 'buffer', '') + s).split('\n')
+        self.__local.buffer = buffer
+
+        if lines:
+            with self.__lock:
+                for line in lines:
+                    self.__stream.write(f'{prefix}{line}\n')
+
+        return len(s)
+
+    def flush(self):
+        with self.__lock:
+            self.__stream.flush()
+
+
+class ThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    # Work submitted by a thread prints with the prefix of that thread
+    def submit(self, fn, /, *args, **kwargs):
+        prefix = get_output_prefix()
+
+        def run():
+            set_output_prefix(prefix)
+            return fn(*args, **kwargs)
+
+        return super().submit(run)
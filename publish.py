@@ -1,15 +1,41 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
+import sys
+import time
 
+from contextlib import ExitStack
 from config import Config
+from file_utils import write_file_atomic
+from metrics import metrics, metrics_formats
+from output import PrefixedOutput, ThreadPoolExecutor, set_output_prefix
 from publisher import Build, GithubPublisher, LocalPublisher
+from server import Server, submit_job
+from watcher import Watcher
 
 
 def add_config_arg(p):
     p.add_argument('-c', '--config', help='Path to configuration file', nargs='+')
 
 
+def add_jobs_arg(p):
+    p.add_argument('-j', '--jobs', help='Number of configs to process in parallel',
+                   type=int, default=1)
+
+
+def add_metrics_arg(p):
+    p.add_argument('--metrics', help='Path to write the timings and counters of the run to')
+    p.add_argument('--metrics-format', help='Format of the metrics, defaults to prometheus '
+                                            'for .prom paths and to json otherwise',
+                   choices=metrics_formats)
+
+
+def add_queue_arg(p):
+    p.add_argument('-q', '--queue', help='Queue the job to be run by the server '
+                                         'waiting for jobs in this directory')
+
+
 parser = argparse.ArgumentParser(description='Publish builds')
 
 subparsers = parser.add_subparsers(dest='command')
@@ -17,13 +43,45 @@ subparsers.required = True
 
 parser_index = subparsers.add_parser('index')
 add_config_arg(parser_index)
+add_jobs_arg(parser_index)
 parser_index.add_argument(
     '-m', '--model', help='Index builds for a given device model')
 parser_index.add_argument(
     '-b', '--build', help='Index specific build')
+parser_index.add_argument(
+    '-r', '--rehash', help='Ignore the hash cache and hash all files again', action='store_true')
+parser_index.add_argument(
+    '--changed', help='Only index devices whose directories changed since they were last indexed',
+    action='store_true')
+add_metrics_arg(parser_index)
+add_queue_arg(parser_index)
+
+parser_serve = subparsers.add_parser('serve')
+add_config_arg(parser_serve)
+parser_serve.add_argument(
+    '-q', '--queue', help='Directory to wait for queued jobs in', required=True)
+parser_serve.add_argument(
+    '-i', '--interval', help='Seconds between checks for queued jobs', type=float, default=1)
+
+parser_watch = subparsers.add_parser('watch')
+add_config_arg(parser_watch)
+parser_watch.add_argument(
+    '-i', '--interval', help='Seconds between checks when inotify is not available',
+    type=int, default=60)
+parser_watch.add_argument(
+    '-s', '--settle', help='Seconds without changes to a device before indexing it',
+    type=int, default=30)
+
+parser_export = subparsers.add_parser('export')
+add_config_arg(parser_export)
+add_jobs_arg(parser_export)
+parser_export.add_argument(
+    '-o', '--output', help='Path to write the builds json file to, defaults to builds_json_path')
+add_metrics_arg(parser_export)
 
 parser_delete = subparsers.add_parser('delete')
 add_config_arg(parser_delete)
+add_jobs_arg(parser_delete)
 
 parser_delete.add_argument('-p', '--dry', help='Only print builds to be deleted', action='store_true')
 parser_delete.add_argument('-a', '--all', help='Delete all builds', action='store_true')
@@ -36,31 +94,84 @@ parser_delete.add_argument(
 parser_delete.add_argument(
     '-e', '--end-date', help='Delete builds ending with this date (inclusive)')
 parser_delete.add_argument('-d', '--date', help='Delete builds from this date')
+add_metrics_arg(parser_delete)
+add_queue_arg(parser_delete)
 
 args = parser.parse_args()
 
-for config_path in args.config:
-    print(f'Using config {config_path}')
+if args.command in ['index', 'delete'] and args.queue:
+    if args.command == 'index':
+        job = {
+            'command': 'index',
+            'model': args.model,
+            'build': os.path.abspath(args.build) if args.build else None,
+            'changed': args.changed,
+        }
+    else:
+        if args.dry:
+            print('Dry runs cannot be queued')
+            sys.exit(-1)
+
+        job = {
+            'command': 'delete',
+            'all': args.all,
+            'model': args.model,
+            'version': args.version,
+            'start_date': args.start_date,
+            'end_date': args.end_date,
+            'date': args.date,
+        }
 
-    config = Config(config_path)
+    name = submit_job(args.queue, job)
+    print(f'Queued {args.command} job {name}')
+    sys.exit(0)
 
+def create_publisher(config):
     publisher_args = [config.builds_json_path, config.builds_path,
                       config.blacklisted_devices, config.ignored_versions,
                       config.builds_limit]
 
+    publisher_kwargs = {
+        'hash_cache_path': config.hash_cache_path,
+        'rehash': getattr(args, 'rehash', False),
+        'hash_workers': config.hash_workers,
+        'hash_mode': config.hash_mode,
+        'hash_queue_size': config.hash_queue_size,
+        'sidecar_mode': config.sidecar_mode,
+        'builds_json_compact': config.builds_json_compact,
+        'builds_shards_path': config.builds_shards_path,
+        'builds_index_path': config.builds_index_path,
+        'check_workers': config.check_workers,
+        'delete_workers': config.delete_workers,
+    }
+
     if config.github_token:
-        publisher = GithubPublisher(
-            config.github_token, config.github_organization, *publisher_args)
-    else:
-        publisher = LocalPublisher(*publisher_args)
+        return GithubPublisher(
+            config.github_token, config.github_organization,
+            *publisher_args, upload_workers=config.upload_workers,
+            upload_retries=config.upload_retries,
+            upload_state_path=config.upload_state_path, **publisher_kwargs)
+
+    return LocalPublisher(*publisher_args, **publisher_kwargs)
+
+
+def run_command(config_path, publisher):
+    with metrics.time('config_seconds', config=config_name(config_path)):
+        run_publisher_command(publisher)
+
+    publisher.print_stats()
+
+    print()
+
 
+def run_publisher_command(publisher):
     if args.command == 'index':
         if args.build:
             publisher.index_build(args.build)
         elif args.model:
             publisher.index_device_builds(args.model)
         else:
-            publisher.index_builds()
+            publisher.index_builds(args.changed)
     elif args.command == 'delete':
         if args.all:
             builds = publisher.find_all_builds()
@@ -71,12 +182,132 @@ for config_path in args.config:
         if not builds:
             print(f'No builds found')
 
-        for build in builds:
-            if args.dry:
+        if args.dry:
+            for build in builds:
                 print(f'Found build {build.name}')
-            else:
-                print(f'Removing build {build.name}')
-                publisher.remove_build(build)
-                print(f'Removed build {build.name}')
+        elif builds:
+            publisher.delete_builds(builds)
+    elif args.command == 'export':
+        publisher.export_builds_json(args.output)
 
-    print()
+
+def run_configs_group(group):
+    # Configs sharing their builds json keep it loaded until all of them
+    # have been processed
+    with ExitStack() as stack:
+        for config_path, publisher in group:
+            set_output_prefix(f'[{config_name(config_path)}] ')
+
+            stack.enter_context(publisher.session())
+            run_command(config_path, publisher)
+
+
+def write_metrics(path, fmt):
+    if fmt is None:
+        fmt = 'prometheus' if path.endswith('.prom') else 'json'
+
+    print(f'Writing metrics to {path}')
+
+    write_file_atomic(path, metrics.format(fmt))
+
+
+def config_name(config_path):
+    return os.path.splitext(os.path.basename(config_path))[0]
+
+
+def builds_json_key(config):
+    return os.path.realpath(config.builds_shards_path or config.builds_json_path)
+
+
+parallel = getattr(args, 'jobs', 1) > 1
+if parallel:
+    sys.stdout = PrefixedOutput(sys.stdout)
+
+publishers = []
+groups = {}
+
+start = time.perf_counter()
+
+# All the configs are read up front to know which of them share their
+# builds json
+configs = [(config_path, Config(config_path)) for config_path in args.config]
+sessions = {}
+
+with ExitStack() as stack:
+    for i, (config_path, config) in enumerate(configs):
+        if parallel:
+            set_output_prefix(f'[{config_name(config_path)}] ')
+
+        print(f'Using config {config_path}')
+
+        publisher = create_publisher(config)
+
+        if args.command in ['serve', 'watch']:
+            # Sessions are handled by the server and the watcher
+            publishers.append(publisher)
+            continue
+
+        if parallel:
+            # Configs writing the same builds json cannot run at the same
+            # time, neither can local configs removing builds from the same
+            # builds path, they run one after another instead
+            shared_paths = [builds_json_key(config)]
+            if isinstance(publisher, LocalPublisher):
+                shared_paths.append(os.path.realpath(config.builds_path))
+
+            group = []
+            for path in shared_paths:
+                shared_group = groups.get(path)
+                if shared_group is None or shared_group is group:
+                    continue
+
+                print(f'Config {config_path} shares {path} with '
+                      f'config {shared_group[0][0]}, running them one after another')
+
+                # Merge the groups of all the configs it shares paths with
+                shared_group.extend(group)
+                for other_path, other_group in groups.items():
+                    if other_group is group:
+                        groups[other_path] = shared_group
+                group = shared_group
+
+            for path in shared_paths:
+                groups[path] = group
+            group.append((config_path, publisher))
+            continue
+
+        # Keep the builds json loaded until all the configs sharing it
+        # have been processed, the others write it as soon as they are done
+        key = builds_json_key(config)
+        session = sessions.get(key)
+        if session is None:
+            session = stack.enter_context(ExitStack())
+            sessions[key] = session
+
+        session.enter_context(publisher.session())
+        run_command(config_path, publisher)
+
+        if all(builds_json_key(other_config) != key
+               for _, other_config in configs[i + 1:]):
+            sessions.pop(key).close()
+
+if groups:
+    set_output_prefix(None)
+
+    unique_groups = []
+    for group in groups.values():
+        if not any(group is g for g in unique_groups):
+            unique_groups.append(group)
+
+    with ThreadPoolExecutor(args.jobs) as executor:
+        for _ in executor.map(run_configs_group, unique_groups):
+            pass
+
+if getattr(args, 'metrics', None):
+    metrics.add('run_seconds', time.perf_counter() - start)
+    write_metrics(args.metrics, args.metrics_format)
+
+if args.command == 'serve':
+    Server(publishers, args.queue, args.interval).run()
+elif args.command == 'watch':
+    Watcher(publishers, args.interval, args.settle).run()
@@ -1,12 +1,32 @@
 #!/usr/bin/python3
 
+import hashlib
 import json
-
-from github import Github, GithubException
+import mimetypes
+import os
+import sys
+import threading
+
+from bisect import bisect_left, bisect_right
+from collections.abc import MutableMapping, Sequence
+from functools import lru_cache
+from queue import Empty, SimpleQueue
+from contextlib import contextmanager
+from github import Github, GithubException, UnknownObjectException
+from urllib3.util import Retry
 from datetime import datetime
-from time import mktime
+from requests.exceptions import RequestException
+from time import mktime, sleep
 
+from builds_index import BuildsIndex
 from file_utils import *
+from hash_cache import HashCache
+from github_scheduler import GithubScheduler
+from hasher import Hasher
+from json_stream import dumps_object_entries, iter_object_entries
+from metrics import metrics
+from output import ThreadPoolExecutor
+from upload_state import UploadProgress, UploadState, format_duration
 
 
 def raw_date_to_split(raw_date):
@@ -18,14 +38,28 @@ def date_to_unix(date, fmt):
     return int(mktime(time.timetuple()))
 
 
+@lru_cache(maxsize=None)
 def raw_date_to_unix(raw_date):
-    return date_to_unix(raw_date, '%Y%m%d')
+    # Called for every build found, avoid going through strptime
+    if len(raw_date) != 8 or not raw_date.isdigit():
+        raise ValueError(f'Invalid date {raw_date}')
+
+    time = datetime(int(raw_date[0:4]), int(raw_date[4:6]), int(raw_date[6:8]))
+    return int(mktime(time.timetuple()))
 
 
 def split_date_to_unix(split_date):
     return date_to_unix(split_date, '%Y-%m-%d')
 
 
+def intern(s):
+    # Device names, versions, types and dates are shared by many builds,
+    # keep a single copy of each in memory
+    if s is None:
+        return None
+    return sys.intern(s)
+
+
 def print_rlc(s, rlc):
     print("{} | Limit: {}, Remaining: {}, Reset: {}.".format(s, rlc.limit, rlc.remaining, rlc.reset))
 
@@ -36,12 +70,15 @@ def print_rl(rl):
 
 
 class BaseFile:
+    __slots__ = ('path', 'url', 'size', 'sha256', 'filename')
+
     def __init__(self, path, url, size, sha256, filename):
         self.path = path
         self.url = url
         self.size = size
         self.sha256 = sha256
-        self.filename = filename
+        # Extra files such as boot.img are named the same in many builds
+        self.filename = intern(filename)
 
     def __eq__(self, other):
         return self.filename == other.filename and self.sha256 == other.sha256
@@ -56,18 +93,33 @@ class BaseFile:
         return cls(path, url, size, sha256, filename)
 
     @classmethod
-    def extract_data_from_path(cls, path):
+    def extract_data_from_entry(cls, entry, hasher=None):
+        # The stat result of the entry is reused for the size and for the
+        # hash cache lookup
+        path = entry.path
         url = None
-        size = file_size(path)
-        sha256 = file_sha256(path)
-        filename = path_filename(path)
+        stat = entry.stat()
+        size = stat.st_size
+        if hasher is None:
+            sha256 = file_sha256(path)
+        else:
+            sha256 = hasher.sha256(path, stat)
+        filename = entry.name
         return path, url, size, sha256, filename
 
     @classmethod
-    def from_path(cls, path):
-        args = cls.extract_data_from_path(path)
+    def extract_data_from_path(cls, path, hasher=None):
+        return cls.extract_data_from_entry(PathEntry(path), hasher)
+
+    @classmethod
+    def from_entry(cls, entry, hasher=None):
+        args = cls.extract_data_from_entry(entry, hasher)
         return cls(*args)
 
+    @classmethod
+    def from_path(cls, path, hasher=None):
+        return cls.from_entry(PathEntry(path), hasher)
+
     def serialize(self):
         serialization = {
             'path': self.path,
@@ -81,21 +133,20 @@ class BaseFile:
 
 
 class RomFile(BaseFile):
+    __slots__ = ('version', 'type', 'device', 'os_patch_level', 'date', 'date_time')
+
     def __init__(self, version, type_, device, os_patch_level, date, date_time, *args):
         super().__init__(*args)
 
-        self.version = version
-        self.type = type_
-        self.device = device
-        self.os_patch_level = os_patch_level
-        self.date = date
+        self.version = intern(version)
+        self.type = intern(type_)
+        self.device = intern(device)
+        self.os_patch_level = intern(os_patch_level)
+        self.date = intern(date)
         self.date_time = date_time
 
-    @classmethod
-    def extract_data_from_path(cls, path):
-        args = super().extract_data_from_path(path)
-
-        filename = path_filename(path)
+    @staticmethod
+    def extract_data_from_filename(filename):
         parts = extract_filename_parts(filename)
 
         version = parts[1]
@@ -107,28 +158,32 @@ class RomFile(BaseFile):
         date = raw_date_to_split(raw_date)
         date_time = raw_date_to_unix(raw_date)
 
-        return version, type_, device, os_patch_level, date, date_time, *args
+        return version, type_, device, os_patch_level, date, date_time
+
+    @classmethod
+    def extract_data_from_entry(cls, entry, hasher=None):
+        args = super().extract_data_from_entry(entry, hasher)
+        return *cls.extract_data_from_filename(entry.name), *args
 
 
 class Build:
+    __slots__ = ('path', 'device', 'files', 'type', 'version', 'date',
+                 'date_time', 'os_patch_level', 'name')
+
     def __init__(self, path, device, files, type_, version, date, date_time, os_patch_level):
         self.path = path
-        self.device = device
+        self.device = intern(device)
         self.files = files
-        self.type = type_
-        self.version = version
-        self.date = date
+        self.type = intern(type_)
+        self.version = intern(version)
+        self.date = intern(date)
         self.date_time = date_time
-        self.os_patch_level = os_patch_level
+        self.os_patch_level = intern(os_patch_level)
+        self.name = remove_filename_ext(files[0].filename)
 
     def __eq__(self, other):
         return self.name == other.name and self.files == other.files
 
-    @property
-    def name(self):
-        rom_file = self.files[0]
-        return remove_filename_ext(rom_file.filename)
-
     @classmethod
     def deserialize(cls, serialization):
         files = [BaseFile.deserialize(s) for s in serialization['files']]
@@ -141,43 +196,68 @@ class Build:
         os_patch_level = serialization.get('os_patch_level')
         return cls(path, device, files, type_, version, date, date_time, os_patch_level)
 
-    @classmethod
-    def from_path(cls, path):
-        if is_build(path):
-            build_files = [path]
+    @staticmethod
+    def file_entries_from_entry(entry):
+        if is_build_entry(entry):
+            build_entries = [entry]
         else:
-            build_files = path_files(path)
+            build_entries = path_file_entries(entry.path)
 
-        if not build_files:
-            raise ValueError(f'{path_filename(path)} has no files')
+        if not build_entries:
+            raise ValueError(f'{entry.name} has no files')
 
-        rom_path = None
-        extra_paths = []
-        for build_file in build_files:
-            if is_build(build_file):
-                rom_path = build_file
+        rom_entry = None
+        extra_entries = []
+        for build_entry in build_entries:
+            if is_build_entry(build_entry):
+                rom_entry = build_entry
             else:
-                extra_paths.append(build_file)
+                extra_entries.append(build_entry)
 
-        if not rom_path:
-            raise ValueError(f'{path_filename(path)} has no build')
+        if not rom_entry:
+            raise ValueError(f'{entry.name} has no build')
 
-        rom_file = RomFile.from_path(rom_path)
+        return rom_entry, extra_entries
+
+    @staticmethod
+    def file_paths_from_path(path):
+        rom_entry, extra_entries = Build.file_entries_from_entry(PathEntry(path))
+        return rom_entry.path, [e.path for e in extra_entries]
+
+    @classmethod
+    def from_entries(cls, path, rom_entry, extra_entries, hasher=None):
+        # The build already holds the metadata extracted from the rom
+        # file, only keep its file data
+        version, type_, device, os_patch_level, date, date_time, *args = \
+            RomFile.extract_data_from_entry(rom_entry, hasher)
+        rom_file = BaseFile(*args)
 
         files = [rom_file]
-        for extra_path in extra_paths:
-            extra_file = BaseFile.from_path(extra_path)
+        for extra_entry in extra_entries:
+            extra_file = BaseFile.from_entry(extra_entry, hasher)
             files.append(extra_file)
 
-        device = rom_file.device
-        type_ = rom_file.type
-        version = rom_file.version
-        date = rom_file.date
-        date_time = rom_file.date_time
-        os_patch_level = rom_file.os_patch_level
-
         return cls(path, device, files, type_, version, date, date_time, os_patch_level)
 
+    @classmethod
+    def candidate_from_entry(cls, path, rom_entry):
+        # Build holding only what can be found out from the name of the
+        # rom file, used to decide whether the build is worth hashing
+        version, type_, device, os_patch_level, date, date_time = \
+            RomFile.extract_data_from_filename(rom_entry.name)
+        rom_file = BaseFile(rom_entry.path, None, None, None, rom_entry.name)
+
+        return cls(path, device, [rom_file], type_, version, date, date_time, os_patch_level)
+
+    @classmethod
+    def from_entry(cls, entry, hasher=None):
+        rom_entry, extra_entries = cls.file_entries_from_entry(entry)
+        return cls.from_entries(entry.path, rom_entry, extra_entries, hasher)
+
+    @classmethod
+    def from_path(cls, path, hasher=None):
+        return cls.from_entry(PathEntry(path), hasher)
+
     def serialize(self):
         serialization = {
             'path': self.path,
@@ -193,81 +273,628 @@ class Build:
         return serialization
 
 
+class BuildChanges:
+    def __init__(self, files, unchanged, renamed, removed, added):
+        self.files = files
+        self.unchanged = unchanged
+        self.renamed = renamed
+        self.removed = removed
+        self.added = added
+
+    @classmethod
+    def from_builds(cls, existing_build, build):
+        existing_files = {(f.filename, f.sha256): f for f in existing_build.files}
+
+        unchanged = []
+        new_files = []
+        for file in build.files:
+            existing_file = existing_files.pop((file.filename, file.sha256), None)
+            if existing_file is None:
+                new_files.append(file)
+            else:
+                unchanged.append(existing_file)
+
+        removed = list(existing_files.values())
+        removed_filenames = {f.filename for f in removed}
+
+        # Files with the same content that only changed their name do not
+        # need to be uploaded again. Only rename them if no other removed
+        # file has the new name, removed files are removed first.
+        removed_by_sha256 = {}
+        for file in removed:
+            removed_by_sha256.setdefault((file.sha256, file.size), []).append(file)
+
+        renamed = []
+        added = []
+        for file in new_files:
+            candidates = removed_by_sha256.get((file.sha256, file.size))
+            if candidates and file.filename not in removed_filenames:
+                existing_file = candidates.pop()
+                removed.remove(existing_file)
+                renamed.append((existing_file, file))
+            else:
+                added.append(file)
+
+        # Keep the order of the files of the updated build, so that the
+        # rom file stays first
+        unchanged_files = {f.filename: f for f in unchanged}
+        files = [unchanged_files.get(f.filename, f) for f in build.files]
+
+        return cls(files, unchanged, renamed, removed, added)
+
+
+class DeviceBuilds(Sequence):
+    def __init__(self, builds=()):
+        # Builds are kept ordered from the newest to the oldest, builds
+        # with the same date keep the order in which they were added
+        self.__builds = []
+        self.__keys = []
+        self.__by_name = {}
+
+        for build in sorted(builds, key=lambda x: x.date_time, reverse=True):
+            self.__builds.append(build)
+            self.__keys.append(-build.date_time)
+            self.__by_name[build.name] = build
+
+    def __getitem__(self, index):
+        return self.__builds[index]
+
+    def __len__(self):
+        return len(self.__builds)
+
+    def __iter__(self):
+        return iter(self.__builds)
+
+    def __contains__(self, build):
+        return self.__by_name.get(build.name) is build
+
+    def get(self, name):
+        return self.__by_name.get(name)
+
+    def position(self, build):
+        # Position the build would be added at
+        return bisect_right(self.__keys, -build.date_time)
+
+    def __index(self, build):
+        key = -build.date_time
+        index = bisect_left(self.__keys, key)
+        while index < len(self.__keys) and self.__keys[index] == key:
+            if self.__builds[index] is build:
+                return index
+            index += 1
+
+        raise ValueError(f'Build {build.name} is not indexed')
+
+    def add(self, build):
+        index = self.position(build)
+        self.__builds.insert(index, build)
+        self.__keys.insert(index, -build.date_time)
+        self.__by_name[build.name] = build
+
+    def remove(self, build):
+        try:
+            index = self.__index(build)
+        except ValueError:
+            # Builds found by queries that did not load the index are
+            # copies of the indexed ones
+            indexed_build = self.__by_name.get(build.name)
+            if indexed_build is None:
+                raise
+
+            build = indexed_build
+            index = self.__index(build)
+        del self.__builds[index]
+        del self.__keys[index]
+
+        if self.__by_name.get(build.name) is build:
+            del self.__by_name[build.name]
+
+
+_builds_jsons = {}
+
+
 class BuildsJson:
-    def __init__(self, path):
-        self.__path = path
-        self.__devices = None
+    def __init__(self, path, compact=False, index_path=None):
+        self._path = path
+        self.__compact = compact
+        self.index = BuildsIndex(index_path) if index_path else None
+        self._devices = None
+        self.__digest = None
+        self.__depth = 0
+        self.__dirty = False
 
-    def __enter__(self):
+    @classmethod
+    def for_path(cls, path, *args):
+        # Publishers sharing the same builds.json file also share its
+        # session, so that it is only loaded and stored once
+        key = os.path.realpath(path)
+        builds_json = _builds_jsons.get(key)
+        if builds_json is None:
+            builds_json = cls(path, *args)
+            _builds_jsons[key] = builds_json
+        return builds_json
+
+    def _dumps(self, serialization):
+        if self.__compact:
+            return json.dumps(serialization, separators=(',', ':'))
+
+        return json.dumps(serialization, indent=4)
+
+    @staticmethod
+    def _digest(raw):
+        # Only the digest of the file contents is kept around to detect
+        # changes, the contents can be as large as the loaded builds
+        return hashlib.sha256(raw.encode()).digest()
+
+    def _write(self, path, serialization, old_digest):
+        return self._write_raw(path, self._dumps(serialization), old_digest)
+
+    def _write_raw(self, path, raw, old_digest):
+        # Write data back into the file, unless nothing changed to avoid
+        # invalidating cached copies of it
+        digest = self._digest(raw)
+        if digest != old_digest:
+            write_file_atomic(path, raw)
+        return digest
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r') as json_file:
+                raw = json_file.read()
+        except IOError:
+            return None, None
+
+        return BuildsJson._digest(raw), json.loads(raw)
+
+    @staticmethod
+    def _deserialize_builds(builds_serialization):
+        return DeviceBuilds(Build.deserialize(s) for s in builds_serialization)
+
+    @staticmethod
+    def _serialize_builds(builds):
+        return [build.serialize() for build in builds]
+
+    def _serialize_devices(self, devices):
+        devices_serialization = {}
+        for device, builds in devices.items():
+            devices_serialization[device] = self._serialize_builds(builds)
+        return devices_serialization
+
+    def _load(self):
         devices = {}
 
         # Read data from the builds.json file
-        try:
-            with open(self.__path, 'r') as builds_json_file:
-                devices_serialization = json.load(builds_json_file)
-        except IOError:
+        digest, devices_serialization = self._read(self._path)
+        if devices_serialization is None:
             devices_serialization = {}
 
-        # Deserialize files
-        for device, builds_serialization in devices_serialization.items():
-            builds = [Build.deserialize(s) for s in builds_serialization]
-            devices[device] = builds
+        # Deserialize files, dropping the serialization of each device
+        # once it is done to keep the peak memory usage low
+        for device in list(devices_serialization.keys()):
+            builds_serialization = devices_serialization.pop(device)
+            devices[device] = self._deserialize_builds(builds_serialization)
 
-        self.__devices = devices
+        self._devices = devices
+        self.__digest = digest
 
-        return devices
+    def _save(self):
+        devices_serialization = self._serialize_devices(self._devices)
 
-    def __exit__(self, exception_type, exception_value, traceback):
-        # Serialize files
-        devices_serialization = {}
-        for device, builds in self.__devices.items():
-            builds_serialization = [build.serialize() for build in builds]
-            devices_serialization[device] = builds_serialization
+        # Keep track of where the builds of each device are stored, so
+        # that queries can read them without decoding the whole file
+        indent = None if self.__compact else 4
+        raw, spans = dumps_object_entries(devices_serialization, indent)
+        self.__digest = self._write_raw(self._path, raw, self.__digest)
+
+        if self.index is not None:
+            self.index.set_spans(spans)
+
+    def _unload(self):
+        self._devices = None
+        self.__digest = None
+
+    def _source_paths(self):
+        return [self._path]
+
+    def __index_devices(self):
+        for device, builds_serialization, span in self._iter_devices_serializations():
+            entries = []
+            for serialization in builds_serialization:
+                name = remove_filename_ext(serialization['files'][0]['filename'])
+                entries.append((name, serialization['version'], serialization['datetime']))
+
+            yield device, span, entries
+
+    def __load_index(self):
+        if self.index is not None and not self.index.loaded:
+            with metrics.time('builds_index_load_seconds'):
+                self.index.load(self._source_paths(), self.__index_devices)
+
+    def __save_index(self):
+        with metrics.time('builds_index_save_seconds'):
+            self.index.save(self._source_paths())
 
-        # Write data back into the builds.json file
-        with open(self.__path, 'w') as builds_json_file:
-            json.dump(devices_serialization, builds_json_file, indent=4)
+    def __unload_index(self):
+        if self.index is not None and self.index.loaded:
+            self.__save_index()
+            self.index.unload()
+
+    def __acquire(self, dirty):
+        if self._devices is None:
+            with metrics.time('builds_json_load_seconds'):
+                self._load()
+            self.__load_index()
+
+        self.__depth += 1
+
+        if dirty:
+            self.__dirty = True
+
+        return self._devices
+
+    def __release(self):
+        self.__depth -= 1
+
+        if self.__depth != 0:
+            return
+
+        if self.__dirty:
+            with metrics.time('builds_json_save_seconds'):
+                self._save()
+
+        self.__unload_index()
+        self._unload()
+        self.__dirty = False
+
+    def __enter__(self):
+        return self.__acquire(True)
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.__release()
 
         return False
 
+    @contextmanager
+    def reading(self):
+        devices = self.__acquire(False)
+        try:
+            yield devices
+        finally:
+            self.__release()
+
+    def flush(self):
+        # Write the changes made so far without ending the session
+        if self._devices is None:
+            return
+
+        if self.__dirty and self.__depth == 1:
+            with metrics.time('builds_json_save_seconds'):
+                self._save()
+            self.__dirty = False
+
+        if self.index is not None and self.index.loaded:
+            self.__save_index()
+
+    @contextmanager
+    def session(self):
+        # Keep the loaded builds in memory until the session ends, the
+        # file is only written once, and only if it has been modified
+        self.__depth += 1
+        try:
+            yield self
+        finally:
+            self.__release()
+
+    def _iter_devices_serializations(self, device_names=None, spans=None):
+        # Only read the builds of the requested devices if it is known
+        # where they are stored, the file is always written as ASCII
+        if device_names is not None and spans is not None:
+            try:
+                with open(self._path, 'rb') as json_file:
+                    for device in sorted(device_names & spans.keys(),
+                                         key=lambda x: spans[x][0]):
+                        start, end = spans[device]
+                        json_file.seek(start)
+                        yield device, json.loads(json_file.read(end - start)), None
+            except IOError:
+                pass
+
+            return
+
+        # Read as bytes so that the spans match the offsets in the file
+        try:
+            with open(self._path, 'rb') as json_file:
+                raw = json_file.read().decode()
+        except IOError:
+            return
+
+        yield from iter_object_entries(raw, device_names)
+
+    def iter_builds(self, device=None, version=None,
+                    min_date_time=None, max_date_time=None):
+        def matches(build_version, date_time):
+            if version is not None and build_version != version:
+                return False
+
+            if min_date_time is not None and date_time < min_date_time:
+                return False
+
+            if max_date_time is not None and date_time >= max_date_time:
+                return False
+
+            return True
+
+        # Look up the matching builds in the version and date indexes
+        # instead of going through all of them
+        names = None
+        spans = None
+        if self.index is not None:
+            self.__load_index()
+
+            candidates = self.index.find(version, min_date_time, max_date_time)
+            if candidates is not None:
+                names = {}
+                for candidate_device, name in candidates:
+                    if device is None or candidate_device == device:
+                        names.setdefault(candidate_device, set()).add(name)
+
+            # Where the builds of each device are stored is only known if
+            # the file has not been modified since the index was built
+            if self._devices is None:
+                spans = self.index.spans
+
+            if self.__depth == 0:
+                self.__unload_index()
+
+        if self._devices is not None:
+            if names is not None:
+                devices_builds = []
+                for device_name in self._devices:
+                    if device_name not in names:
+                        continue
+
+                    builds = self._devices[device_name]
+                    devices_builds.append(sorted(
+                        filter(None, map(builds.get, names[device_name])),
+                        key=lambda x: x.date_time, reverse=True))
+            elif device is not None:
+                devices_builds = [self._devices.get(device, [])]
+            else:
+                devices_builds = self._devices.values()
+
+            for builds in devices_builds:
+                for build in builds:
+                    if matches(build.version, build.date_time):
+                        yield build
+
+            return
+
+        # Nothing is loaded, only deserialize the builds that match
+        # instead of loading the whole index
+        if names is not None:
+            device_names = set(names.keys())
+        else:
+            device_names = None if device is None else {device}
+
+        builds_serializations = self._iter_devices_serializations(device_names, spans)
+        for _, builds_serialization, _ in builds_serializations:
+            for serialization in builds_serialization:
+                if matches(serialization['version'], serialization['datetime']):
+                    yield Build.deserialize(serialization)
+
+    def export(self, path):
+        with self.reading() as devices:
+            devices_serialization = self._serialize_devices(devices)
+
+        old_digest, _ = self._read(path)
+        self._write(path, devices_serialization, old_digest)
+
+
+class ShardedDevices(MutableMapping):
+    def __init__(self, device_names, load_fn):
+        self.__device_names = device_names
+        self.__load_fn = load_fn
+        self.loaded = {}
+
+    def __getitem__(self, device):
+        builds = self.loaded.get(device)
+        if builds is not None:
+            return builds
+
+        if device not in self.__device_names:
+            raise KeyError(device)
+
+        builds = self.__load_fn(device)
+        self.loaded[device] = builds
+        return builds
+
+    def __setitem__(self, device, builds):
+        self.__device_names.add(device)
+        self.loaded[device] = builds
+
+    def __delitem__(self, device):
+        self.__device_names.remove(device)
+        self.loaded.pop(device, None)
+
+    def __iter__(self):
+        return iter(sorted(self.__device_names))
+
+    def __len__(self):
+        return len(self.__device_names)
+
+
+class ShardedBuildsJson(BuildsJson):
+    MANIFEST_FILENAME = 'manifest.json'
+
+    def __init__(self, path, compact=False, index_path=None):
+        super().__init__(path, compact, index_path)
+        self.__manifest_digest = None
+        self.__shards_digest = {}
+
+    def __manifest_path(self):
+        return path_join(self._path, self.MANIFEST_FILENAME)
+
+    def __shard_path(self, device):
+        return path_join(self._path, f'{device}.json')
+
+    def __load_shard(self, device):
+        with metrics.time('builds_json_load_seconds'):
+            digest, builds_serialization = self._read(self.__shard_path(device))
+            if builds_serialization is None:
+                builds_serialization = []
+
+            self.__shards_digest[device] = digest
+
+            return self._deserialize_builds(builds_serialization)
+
+    def _source_paths(self):
+        if self._devices is not None:
+            device_names = list(self._devices)
+        else:
+            _, manifest = self._read(self.__manifest_path())
+            device_names = manifest['devices'].keys() if manifest is not None else []
+
+        return [self.__manifest_path()] + \
+            [self.__shard_path(device) for device in sorted(device_names)]
+
+    def _iter_devices_serializations(self, device_names=None, spans=None):
+        _, manifest = self._read(self.__manifest_path())
+        if manifest is None:
+            return
+
+        for device in sorted(manifest['devices'].keys()):
+            if device_names is not None and device not in device_names:
+                continue
+
+            _, builds_serialization = self._read(self.__shard_path(device))
+            if builds_serialization is not None:
+                yield device, builds_serialization, None
+
+    def _load(self):
+        # Only the manifest is read here, device shards are read when
+        # they are first accessed
+        digest, manifest = self._read(self.__manifest_path())
+        if manifest is None:
+            manifest = {'devices': {}}
+
+        device_names = set(manifest['devices'].keys())
+
+        self._devices = ShardedDevices(device_names, self.__load_shard)
+        self.__manifest_digest = digest
+        self.__shards_digest = {}
+
+    def _save(self):
+        os.makedirs(self._path, exist_ok=True)
+
+        for device, builds in self._devices.loaded.items():
+            builds_serialization = self._serialize_builds(builds)
+            self.__shards_digest[device] = self._write(
+                self.__shard_path(device), builds_serialization,
+                self.__shards_digest.get(device))
+
+        manifest = {
+            'devices': {device: path_filename(self.__shard_path(device))
+                        for device in self._devices},
+        }
+        self.__manifest_digest = self._write(
+            self.__manifest_path(), manifest, self.__manifest_digest)
+
+    def _unload(self):
+        super()._unload()
+        self.__manifest_digest = None
+        self.__shards_digest = {}
+
 
 class Publisher:
     def __init__(self, builds_json_path, builds_path,
-                 blacklisted_devices, ignored_versions, builds_limit):
+                 blacklisted_devices, ignored_versions, builds_limit,
+                 hash_cache_path=None, rehash=False, hash_workers=1,
+                 hash_mode='readinto', builds_json_compact=False,
+                 builds_shards_path=None, check_workers=1,
+                 builds_index_path=None, delete_workers=1, sidecar_mode='ignore',
+                 hash_queue_size=0):
         self._builds_path = builds_path
-        self.__builds_json = BuildsJson(builds_json_path)
+        self._removed_build_paths = set()
+        self._check_workers = check_workers
+        self._delete_workers = delete_workers
+        self.__builds_json_path = builds_json_path
+        if builds_shards_path:
+            self.__builds_json = ShardedBuildsJson.for_path(
+                builds_shards_path, builds_json_compact, builds_index_path)
+        else:
+            self.__builds_json = BuildsJson.for_path(
+                builds_json_path, builds_json_compact, builds_index_path)
+        self.__hash_cache = HashCache.for_path(hash_cache_path, rehash, hash_mode)
+        self.__hasher = Hasher(self.__hash_cache, hash_workers, sidecar_mode, hash_queue_size)
         self.__blacklisted_devices = blacklisted_devices
         self.__ignored_versions = ignored_versions
         self.__builds_limit = builds_limit
 
+    @property
+    def builds_path(self):
+        return self._builds_path
+
     def _is_build_uploaded(self, build):
         pass
 
+    def _are_builds_uploaded(self, builds):
+        with ThreadPoolExecutor(self._check_workers) as executor:
+            return list(executor.map(self._is_build_uploaded, builds))
+
     def _upload_build(self, build):
         pass
 
     def _unupload_build(self, build):
         pass
 
+    def _unupload_builds(self, builds):
+        # Returns the error that happened while removing each build, or
+        # None if it has been removed
+        def unupload_build(build):
+            try:
+                self._unupload_build(build)
+            except Exception as e:
+                return e
+
+            return None
+
+        with ThreadPoolExecutor(self._delete_workers) as executor:
+            return list(executor.map(unupload_build, builds))
+
     def _upload_build_file(self, build, file):
         pass
 
+    def _upload_build_files(self, build, files):
+        for file in files:
+            self._upload_build_file(build, file)
+
     def _remove_build_file(self, build, file):
         pass
 
+    def _rename_build_file(self, build, existing_file, file):
+        self._remove_build_file(build, existing_file)
+        self._upload_build_file(build, file)
+
     def _update_build_file(self, build, file):
         pass
 
-    def find_all_builds(self):
-        all_builds = []
+    @contextmanager
+    def session(self):
+        with self.__builds_json.session(), self.__hasher:
+            yield self
 
-        with self.__builds_json as devices:
-            for builds in devices.values():
-                all_builds.extend(builds)
+    def flush(self):
+        self.__builds_json.flush()
+        self.__hasher.flush()
 
-        return all_builds
+    def reset(self):
+        self.__hasher.reset()
 
-    def find_builds(self, device=None, version=None, min_date=None, max_date=None, date=None):
+    def find_all_builds(self):
+        return list(self.__builds_json.iter_builds())
+
+    def iter_builds(self, device=None, version=None, min_date=None, max_date=None, date=None):
         if (min_date is not None or max_date is not None) and date is not None:
             raise ValueError('Cannot filter for both date and min/max date')
 
@@ -284,75 +911,80 @@ class Publisher:
             ONE_DAY_SECONDS = 24 * 60 * 60
             max_date_unix = raw_date_to_unix(max_date) + ONE_DAY_SECONDS
 
-        matching_builds = []
+        return self.__builds_json.iter_builds(device, version,
+                                              min_date_unix, max_date_unix)
 
-        with self.__builds_json as devices:
-            for builds_device_name, builds in devices.items():
-                if device is not None and builds_device_name != device:
-                    continue
+    def find_builds(self, device=None, version=None, min_date=None, max_date=None, date=None):
+        return list(self.iter_builds(device, version, min_date, max_date, date))
 
-                for build in builds:
-                    if version is not None and build.version != version:
-                        continue
+    def _get_device_builds(self, devices, device):
+        builds = devices.get(device)
+        if builds is None:
+            builds = DeviceBuilds()
+            devices[device] = builds
+        return builds
 
-                    if min_date_unix is not None and \
-                            build.date_time < min_date_unix:
-                        continue
+    def _get_build_by_name(self, builds, build_name):
+        return builds.get(build_name)
 
-                    if max_date_unix is not None and \
-                            build.date_time >= max_date_unix:
-                        continue
+    def _build_skipped_reason(self, build):
+        if build.device in self.__blacklisted_devices:
+            return f'Build {build.name} is for blacklisted device {build.device}, skipping'
 
-                    matching_builds.append(build)
+        if build.version in self.__ignored_versions:
+            return f'Build {build.name} is for ignored version {build.version}, skipping'
 
-        return matching_builds
+        return None
 
-    def _get_device_builds(self, devices, device):
-        return devices.setdefault(device, [])
+    def is_build_skipped(self, build):
+        reason = self._build_skipped_reason(build)
+        if reason is None:
+            return False
 
-    def _get_build_by_name(self, builds, build_name):
-        for build in builds:
-            if build.name == build_name:
-                return build
+        print(reason)
+        return True
 
-        return None
+    def _set_device_fingerprint(self, device, fingerprint):
+        if self.__builds_json.index is not None:
+            self.__builds_json.index.set_fingerprint(device, fingerprint)
 
-    def is_build_skipped(self, build):
-        if build.device in self.__blacklisted_devices:
-            print(f'Build {build.name} is for blacklisted device {build.device}, skipping')
-            return True
+    def _index_build(self, builds, build):
+        builds.add(build)
 
-        if build.version in self.__ignored_versions:
-            print(f'Build {build.name} is for ignored version {build.version}, skipping')
-            return True
+        if self.__builds_json.index is not None:
+            self.__builds_json.index.add(build)
 
-        return False
+        # The device has to be indexed again the next time changed
+        # devices are indexed, unless it is done being indexed now
+        self._set_device_fingerprint(build.device, None)
 
     def _unindex_build(self, builds, build):
         try:
             builds.remove(build)
         except ValueError:
-            pass
+            return
+
+        if self.__builds_json.index is not None:
+            self.__builds_json.index.remove(build)
+
+        self._set_device_fingerprint(build.device, None)
 
     def _unindex_builds(self, builds, removed_builds):
         for build in removed_builds:
-            builds.remove(build)
+            self._unindex_build(builds, build)
         return removed_builds
 
-    def _sort_builds_by_datetime(self, builds):
-        builds.sort(key=lambda x: x.date_time, reverse=True)
-
     def _get_more_than_limit_builds(self, builds):
-        self._sort_builds_by_datetime(builds)
         if self.__builds_limit == 0:
             return []
 
         return builds[self.__builds_limit:]
 
     def _is_device_build_more_than_limit(self, builds, build):
-        new_builds = builds[:] + [build]
-        old_builds = self._get_more_than_limit_builds(new_builds)
-        return build in old_builds
+        if self.__builds_limit == 0:
+            return False
+
+        return builds.position(build) >= self.__builds_limit
 
     def _remove_build(self, builds, build):
         self._unupload_build(build)
@@ -368,12 +1000,44 @@ class Publisher:
             builds = self._get_device_builds(devices, build.device)
             self._remove_build(builds, build)
 
+    def remove_builds(self, builds):
+        # Remove all the builds at once so that backends can batch and
+        # parallelize the removals, builds that failed to be removed are
+        # kept in the index
+        with metrics.time('phase_seconds', phase='remove'):
+            errors = self._unupload_builds(builds)
+
+            with self.__builds_json as devices:
+                for build, error in zip(builds, errors):
+                    if error is None:
+                        device_builds = self._get_device_builds(devices, build.device)
+                        self._unindex_build(device_builds, build)
+
+            return errors
+
+    def delete_builds(self, builds):
+        print(f'Removing {len(builds)} builds')
+        errors = self.remove_builds(builds)
+
+        for build, error in zip(builds, errors):
+            if error is None:
+                print(f'Removed build {build.name}')
+            else:
+                print(f'Failed to remove build {build.name}: {error}')
+
+        failed = len([error for error in errors if error is not None])
+        print(f'Removed {len(builds) - failed} builds, failed to remove {failed} builds')
+
     def is_build_uploaded(self, build):
         print(f'Checking if build {build.name} is uploaded')
         return self._is_build_uploaded(build)
 
-    def _unindex_not_uploaded_builds(self, builds):
-        unindexed_builds = [b for b in builds if not self.is_build_uploaded(b)]
+    def are_builds_uploaded(self, builds):
+        print(f'Checking if {len(builds)} builds are uploaded')
+        return self._are_builds_uploaded(builds)
+
+    def _unindex_not_uploaded_builds(self, builds, uploaded):
+        unindexed_builds = [b for b, u in zip(builds, uploaded) if not u]
         return self._unindex_builds(builds, unindexed_builds)
 
     def _unindex_skipped_builds(self, builds):
@@ -390,26 +1054,115 @@ class Publisher:
             print(f'Build {build.name} exceeds builds limit, removing')
         return removed_builds
 
-    def clean_device_builds(self, devices, device):
-        builds = self._get_device_builds(devices, device)
+    def clean_devices_builds(self, devices, device_names):
+        with metrics.time('phase_seconds', phase='clean'):
+            devices_builds = [self._get_device_builds(devices, device)
+                              for device in device_names]
 
-        removed_builds = self._unindex_skipped_builds(builds)
-        for build in removed_builds:
-            print(f'Build {build.name} is skipped, removing from index')
+            for builds in devices_builds:
+                removed_builds = self._unindex_skipped_builds(builds)
+                for build in removed_builds:
+                    print(f'Build {build.name} is skipped, removing from index')
 
-        removed_builds = self._unindex_not_uploaded_builds(builds)
-        for build in removed_builds:
-            print(f'Build {build.name} is not uploaded, removing from index')
+            # Check all the builds at once so that backends can batch and
+            # parallelize the checks, then apply the results per device
+            all_builds = [build for builds in devices_builds for build in builds]
+            all_uploaded = self.are_builds_uploaded(all_builds)
+
+            index = 0
+            for builds in devices_builds:
+                uploaded = all_uploaded[index:index + len(builds)]
+                index += len(builds)
+
+                removed_builds = self._unindex_not_uploaded_builds(builds, uploaded)
+                for build in removed_builds:
+                    print(f'Build {build.name} is not uploaded, removing from index')
+
+                self._remove_more_than_limit_builds_print(builds)
 
-        self._remove_more_than_limit_builds_print(builds)
+    def clean_device_builds(self, devices, device):
+        self.clean_devices_builds(devices, [device])
 
     def clean_builds(self, devices):
-        for device in devices.keys():
-            self.clean_device_builds(devices, device)
+        self.clean_devices_builds(devices, list(devices.keys()))
 
         print()
 
-    def _index_device_path(self, devices, device_path):
+    def _select_device_path_builds(self, devices, device_path, scanned_builds):
+        # First phase of indexing a device, only the names of the rom files
+        # are parsed, and the builds that would be skipped or removed for
+        # exceeding the limit right after being added are left out so that
+        # they are never hashed
+        device_name = path_filename(device_path)
+        builds = self._get_device_builds(devices, device_name)
+
+        errors = []
+        skipped = []
+        over_limit = []
+        selected = []
+
+        # The builds of the device as they would be after adding the
+        # selected ones
+        selected_builds = DeviceBuilds(builds)
+
+        for build_entry, file_entries in scanned_builds:
+            try:
+                if isinstance(file_entries, ValueError):
+                    raise file_entries
+
+                rom_entry, _ = file_entries
+                candidate = Build.candidate_from_entry(build_entry.path, rom_entry)
+                if device_name != candidate.device:
+                    raise ValueError(f'Device path {device_path} contains ' +
+                                     f'build {candidate.name} for device {candidate.device}')
+            except ValueError as e:
+                errors.append(e)
+                continue
+
+            if self._build_skipped_reason(candidate) is not None:
+                skipped.append(candidate)
+                continue
+
+            # Existing builds are hashed to find out if they changed,
+            # unless newer builds already pushed them out
+            if builds.get(candidate.name) is not None:
+                if selected_builds.get(candidate.name) is not None:
+                    selected.append((candidate, file_entries))
+                continue
+
+            if self._is_device_build_more_than_limit(selected_builds, candidate):
+                over_limit.append(candidate)
+                continue
+
+            selected_builds.add(candidate)
+            selected.append((candidate, file_entries))
+
+            # Newer builds push out older ones, existing builds pushed out
+            # are removed while adding the selected builds, no need to
+            # hash them either
+            for build in self._get_more_than_limit_builds(selected_builds):
+                selected_builds.remove(build)
+                selected = [s for s in selected if s[0].name != build.name]
+                if builds.get(build.name) is not build:
+                    over_limit.append(build)
+
+        return errors, skipped, over_limit, selected
+
+    def _select_device_paths_builds(self, devices, device_paths, devices_scans):
+        with metrics.time('phase_seconds', phase='select'):
+            devices_selections = {}
+
+            for device_path in device_paths:
+                scanned_builds, _ = devices_scans.get(device_path, (None, None))
+                if scanned_builds is None:
+                    continue
+
+                devices_selections[device_path] = \
+                    self._select_device_path_builds(devices, device_path, scanned_builds)
+
+            return devices_selections
+
+    def _index_device_path(self, devices, device_path, scanned_builds=None, selection=None):
         device_name = path_filename(device_path)
 
         print(f'Found device path {device_path}')
@@ -419,105 +1172,311 @@ class Publisher:
             print()
             return
 
-        build_paths = path_files_or_dirs(device_path, descending=True)
+        if scanned_builds is None:
+            scanned_builds = self._scan_device_path(device_path)
+
+        if selection is None:
+            selection = self._select_device_path_builds(devices, device_path, scanned_builds)
+
+        errors, skipped, over_limit, selected = selection
+
+        for error in errors:
+            print(error)
+
+        for candidate in skipped:
+            print(self._build_skipped_reason(candidate))
+            metrics.add('builds', state='skipped')
 
         builds = self._get_device_builds(devices, device_name)
-        new_builds = []
 
-        for build_path in build_paths:
-            try:
-                build = Build.from_path(build_path)
-                if device_name != build.device:
-                    raise ValueError(f'Device path {device_path} contains ' +
-                                     f'build {build.name} for device {build.device}')
+        self._add_builds(builds, self._hash_builds(selected))
+
+        # Older than all the selected builds, reported after them like
+        # _add_builds would
+        for candidate in over_limit:
+            print(f'Found new build {candidate.name} that exceeds builds limit, removing')
+            self._unupload_build(candidate)
+            metrics.add('builds', state='over_limit')
+            print()
+
+        print()
 
-                new_builds.append(build)
+    def _hash_builds(self, selected):
+        # Second phase, only the selected builds are hashed, each one is
+        # published as soon as it is hashed while the next ones are still
+        # being hashed in the background
+        for candidate, file_entries in selected:
+            try:
+                yield Build.from_entries(candidate.path, *file_entries, self.__hasher)
             except ValueError as e:
                 print(e)
 
-        self._add_builds(builds, new_builds)
+    def _scan_device_path(self, device_path):
+        # Read each directory once, the entries found carry their type and
+        # stat results so that the files do not have to be looked up again
+        scanned_builds = []
 
-        print()
+        build_entries = path_file_or_dir_entries(device_path, descending=True)
+        self.__hasher.add_sidecars(build_entries)
+
+        # Checksum sidecars of single file builds are not builds themselves
+        names = {build_entry.name for build_entry in build_entries}
+
+        for build_entry in build_entries:
+            if sidecar_target_filename(build_entry.name) in names:
+                continue
+
+            try:
+                file_entries = Build.file_entries_from_entry(build_entry)
+                rom_entry, extra_entries = file_entries
+                self.__hasher.add_sidecars([rom_entry] + extra_entries)
+            except ValueError as e:
+                file_entries = e
+
+            scanned_builds.append((build_entry, file_entries))
+
+        return scanned_builds
+
+    def _device_fingerprint(self, scanned_builds):
+        # Covers everything that changes the way the builds of a device
+        # are indexed, the contents of files are only checked through
+        # their size and modification time. Builds removed while indexing
+        # are left out, as they will not be found by the next scan.
+        sha256 = hashlib.sha256()
 
-    def index_device_builds(self, device):
+        settings = [sorted(self.__blacklisted_devices),
+                    sorted(self.__ignored_versions), self.__builds_limit]
+        sha256.update(json.dumps(settings).encode())
+
+        for build_entry, file_entries in scanned_builds:
+            if build_entry.path in self._removed_build_paths:
+                continue
+
+            sha256.update(f'{build_entry.name}\0'.encode())
+            if isinstance(file_entries, ValueError):
+                continue
+
+            rom_entry, extra_entries = file_entries
+            for entry in [rom_entry] + extra_entries:
+                stat = entry.stat()
+                sha256.update(f'{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\0'.encode())
+
+        return sha256.hexdigest()
+
+    def _scan_device_paths(self, device_paths):
+        def scan_device_path(device_path):
+            scanned_builds = self._scan_device_path(device_path)
+
+            fingerprint = None
+            if self.__builds_json.index is not None:
+                fingerprint = self._device_fingerprint(scanned_builds)
+
+            return scanned_builds, fingerprint
+
+        self._removed_build_paths = set()
+
+        device_paths = [device_path for device_path in device_paths
+                        if path_filename(device_path) not in self.__blacklisted_devices]
+
+        # Each file is stat'ed while scanning, scan the devices
+        # concurrently since each stat can be a network round trip
+        with metrics.time('phase_seconds', phase='scan'), \
+                ThreadPoolExecutor(self._check_workers) as executor:
+            return dict(zip(device_paths, executor.map(scan_device_path, device_paths)))
+
+    def _forget_missing_hashes(self, path, devices_scans):
+        # Hashes of the files that were not found while scanning are not
+        # needed anymore
+        paths = set()
+        for scanned_builds, _ in devices_scans.values():
+            for _, file_entries in scanned_builds:
+                if isinstance(file_entries, ValueError):
+                    continue
+
+                rom_entry, extra_entries = file_entries
+                paths.add(rom_entry.path)
+                paths.update(entry.path for entry in extra_entries)
+
+        # Blacklisted devices are not scanned, but other publishers sharing
+        # the hash cache can still index them
+        blacklisted_device_paths = [path_join(self._builds_path, device)
+                                    for device in self.__blacklisted_devices]
+
+        self.__hash_cache.forget_missing(path, paths, blacklisted_device_paths)
+
+    def _prefetch_device_paths_hashes(self, device_paths, devices_selections):
+        # Start hashing the files of the selected builds in the background,
+        # the hashes are then collected in order while indexing each device
+        for device_path in device_paths:
+            if device_path not in devices_selections:
+                continue
+
+            _, _, _, selected = devices_selections[device_path]
+            for _, (rom_entry, extra_entries) in selected:
+                self.__hasher.prefetch([rom_entry] + extra_entries)
+
+    def _index_scanned_device_paths(self, devices, device_paths, devices_scans):
+        # Builds are selected once the existing ones have been cleaned
+        devices_selections = self._select_device_paths_builds(
+            devices, device_paths, devices_scans)
+        self._prefetch_device_paths_hashes(device_paths, devices_selections)
+
+        for device_path in device_paths:
+            scanned_builds, fingerprint = devices_scans.get(device_path, (None, None))
+            with metrics.time('phase_seconds', phase='index'), \
+                    metrics.time('device_seconds', device=path_filename(device_path)):
+                self._index_device_path(devices, device_path, scanned_builds,
+                                        devices_selections.get(device_path))
+
+            if fingerprint is not None:
+                fingerprint = self._device_fingerprint(scanned_builds)
+            self._set_device_fingerprint(path_filename(device_path), fingerprint)
+
+        self._correct_mismatched_hashes()
+
+    def _changed_device_paths(self, devices, devices_scans):
+        fingerprints = self.__builds_json.index.fingerprints
+
+        changed_device_paths = []
+        for device_path, (_, fingerprint) in devices_scans.items():
+            if fingerprints.get(path_filename(device_path)) != fingerprint:
+                changed_device_paths.append(device_path)
+
+        # Devices that were indexed before but whose directory is gone
+        # only need to be cleaned
+        scanned_device_names = {path_filename(p) for p in devices_scans}
+        removed_device_names = [device for device in devices
+                                if device not in scanned_device_names
+                                and fingerprints.get(device) is not None]
+
+        return changed_device_paths, removed_device_names
+
+    def index_device_builds(self, device, changed=False):
         path = path_join(self._builds_path, device)
 
         print(f'Indexing path {path}')
 
-        with self.__builds_json as devices:
+        with self.__hasher, self.__builds_json as devices:
+            devices_scans = self._scan_device_paths([path])
+            self._forget_missing_hashes(path, devices_scans)
+
+            if changed and self.__builds_json.index is not None:
+                changed_device_paths, _ = self._changed_device_paths({}, devices_scans)
+                if not changed_device_paths:
+                    print(f'Device {device} is unchanged')
+                    return
+
             self.clean_device_builds(devices, device)
 
-            self._index_device_path(devices, path)
+            self._index_scanned_device_paths(devices, [path], devices_scans)
 
-    def index_builds(self):
+    def index_builds(self, changed=False):
         print(f'Indexing path {self._builds_path}')
 
         device_paths = path_dirs(self._builds_path)
 
-        with self.__builds_json as devices:
-            self.clean_builds(devices)
+        with self.__hasher, self.__builds_json as devices:
+            devices_scans = self._scan_device_paths(device_paths)
+            self._forget_missing_hashes(self._builds_path, devices_scans)
 
-            for device_path in device_paths:
-                self._index_device_path(devices, device_path)
+            if changed and self.__builds_json.index is None:
+                print('Builds index is disabled, indexing all devices')
+                changed = False
+
+            if changed:
+                changed_device_paths, removed_device_names = \
+                    self._changed_device_paths(devices, devices_scans)
+
+                print(f'Found {len(changed_device_paths)} changed devices, '
+                      f'{len(devices_scans) - len(changed_device_paths)} unchanged')
+
+                device_names = [path_filename(p) for p in changed_device_paths]
+                self.clean_devices_builds(devices, device_names + removed_device_names)
+                print()
+
+                for device in removed_device_names:
+                    self._set_device_fingerprint(device, None)
+
+                device_paths = changed_device_paths
+            else:
+                self.clean_builds(devices)
+
+            self._index_scanned_device_paths(devices, device_paths, devices_scans)
 
     def index_build(self, path):
         print(f'Indexing path {path}')
 
-        build = Build.from_path(path)
-        self.add_build(build)
+        rom_entry, extra_entries = Build.file_entries_from_entry(PathEntry(path))
 
-    def _update_build(self, existing_build, build):
-        # Find all files that are not exactly the same inside the
-        # updated build and remove them from the existing build
-        removed_files = []
-        for existing_file in existing_build.files:
-            found = False
+        # Single file builds keep their checksum sidecars next to them
+        sidecar_entries = [PathEntry(rom_entry.path + ext) for ext in sidecar_extensions]
+        sidecar_entries = [e for e in sidecar_entries if e.is_file()]
 
-            for file in build.files:
-                if file == existing_file:
-                    found = True
-                    break
+        with self.__hasher:
+            self.__hasher.add_sidecars([rom_entry] + extra_entries + sidecar_entries)
+            self.__hasher.prefetch(extra_entries)
+            build = Build.from_entries(path, rom_entry, extra_entries, self.__hasher)
 
-            if not found:
-                removed_files.append(existing_file)
+            self.add_build(build)
+            self._correct_mismatched_hashes()
 
-        for file in removed_files:
-            print(f'Removing old file {file.filename}')
-            self._remove_build_file(existing_build, file)
-            existing_build.files.remove(file)
+    def _correct_build_file_sha256(self, build, file, sha256):
+        file.sha256 = sha256
 
-        # Find all files that are not exactly the same inside the
-        # existing build and add them to the existing build
-        added_files = []
-        for file in build.files:
-            found = False
+    def _correct_mismatched_hashes(self):
+        # Hashes taken from checksum sidecars that turned out to be wrong
+        # are corrected in the index, the files themselves were published
+        # as they are and do not have to be published again
+        mismatches = self.__hasher.verified_mismatches()
+        if not mismatches:
+            return
+
+        with self.__builds_json as devices:
+            for path, sha256 in mismatches.items():
+                device = path_relative(self._builds_path, path).split(os.sep)[0]
+                builds = devices.get(device)
+                if builds is None:
+                    continue
 
-            for existing_file in existing_build.files:
-                if file == existing_file:
-                    found = True
-                    break
+                for build in builds:
+                    for file in build.files:
+                        if file.path == path and file.sha256 != sha256:
+                            print(f'Correcting hash of file {file.filename} of build {build.name}')
+                            self._correct_build_file_sha256(build, file, sha256)
+
+    def _update_build(self, existing_build, build):
+        changes = BuildChanges.from_builds(existing_build, build)
+
+        for file in changes.removed:
+            print(f'Removing old file {file.filename}')
+            self._remove_build_file(existing_build, file)
 
-            if not found:
-                added_files.append(file)
+        for existing_file, file in changes.renamed:
+            print(f'Renaming file {existing_file.filename} to {file.filename}')
+            self._rename_build_file(existing_build, existing_file, file)
 
-        for file in added_files:
+        for file in changes.added:
             print(f'Uploading new file {file.filename}')
-            self._upload_build_file(build, file)
-            existing_build.files.append(file)
+
+        with metrics.time('phase_seconds', phase='upload'):
+            self._upload_build_files(existing_build, changes.added)
+        existing_build.files = changes.files
 
     def _add_builds(self, builds, new_builds):
         removed_builds = self._remove_more_than_limit_builds_print(builds)
+        removed_names = {build.name for build in removed_builds}
 
         for build in new_builds:
             # This is not actually a new build, it was just removed earlier
             # because it exceeded the limit after a more recent build has
             # been added. Do not try adding it again.
-            if build in removed_builds:
+            if build.name in removed_names and build in removed_builds:
                 continue
 
             self._add_build(builds, build)
             new_removed_builds = self._remove_more_than_limit_builds_print(builds)
             removed_builds = removed_builds + new_removed_builds
+            removed_names.update(b.name for b in new_removed_builds)
 
     def _add_build(self, builds, build):
         if self.is_build_skipped(build):
@@ -529,15 +1488,20 @@ class Publisher:
                 and self._is_device_build_more_than_limit(builds, build):
             print(f'Found new build {build.name} that exceeds builds limit, removing')
             self._unupload_build(build)
+            metrics.add('builds', state='over_limit')
         elif existing_build is None:
             print(f'Found new build {build.name}')
-            self._upload_build(build)
-            builds.append(build)
+            with metrics.time('phase_seconds', phase='upload'):
+                self._upload_build(build)
+            self._index_build(builds, build)
+            metrics.add('builds', state='new')
         elif existing_build != build:
             print(f'Found existing build {build.name} with changes, updating')
             self._update_build(existing_build, build)
+            metrics.add('builds', state='updated')
         else:
             print(f'Found existing build {build.name}')
+            metrics.add('builds', state='existing')
 
         print()
 
@@ -546,10 +1510,22 @@ class Publisher:
             builds = self._get_device_builds(devices, build.device)
             self._add_builds(builds, [build])
 
+    def export_builds_json(self, path=None):
+        if path is None:
+            path = self.__builds_json_path
+
+        print(f'Exporting builds to {path}')
+
+        with metrics.time('phase_seconds', phase='export'):
+            self.__builds_json.export(path)
+
+    def print_stats(self):
+        self.__hasher.print_stats()
+
 
 class LocalPublisher(Publisher):
-    def __init__(self, *args):
-        super().__init__(*args)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
 
     def _is_build_uploaded(self, build):
         return is_dir_or_file(build.path)
@@ -560,38 +1536,114 @@ class LocalPublisher(Publisher):
         except FileNotFoundError:
             pass
 
+        self._removed_build_paths.add(build.path)
+
+    def _upload_build_file(self, build, file):
+        file.url = path_relative(self._builds_path, file.path)
+
     def _upload_build(self, build):
         for file in build.files:
-            file.url = path_relative(self._builds_path, file.path)
+            self._upload_build_file(build, file)
+
+
+_github_sessions = {}
 
 
 class GithubPublisher(Publisher):
-    def __init__(self, github_token, github_organization, *args):
-        super().__init__(*args)
+    def __init__(self, github_token, github_organization, *args,
+                 upload_workers=1, upload_retries=3, upload_state_path=None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
 
-        self._github = Github(github_token)
+        self.__github_token = github_token
 
-        rl = self._github.get_rate_limit()
-        print_rl(rl)
+        self.__upload_workers = upload_workers
+        self.__upload_retries = upload_retries
+        self.__upload_state = UploadState(upload_state_path)
+
+        # Repositories, their releases and the assets of the releases
+        # are looked up once per run and kept up to date as releases and
+        # assets are created, renamed and deleted
+        self.__repos = {}
+        self.__releases = {}
+        self.__assets = {}
+        self.__cache_lock = threading.Lock()
+
+        # Extra clients used to check the uploaded builds concurrently,
+        # each one is only used by one thread at a time
+        self.__clients = SimpleQueue()
+
+        # Publishers using the same token share a client, and the
+        # scheduler keeping track of its rate limit
+        session = _github_sessions.get(github_token)
+        if session is None:
+            github = self._create_github()
+            scheduler = GithubScheduler(github)
+
+            rl = scheduler.call('get_rate_limit', github.get_rate_limit)
+            print_rl(rl)
+
+            session = github, scheduler
+            _github_sessions[github_token] = session
+
+        self._github, self._scheduler = session
 
         if github_organization:
-            self._repo_place = self._github.get_organization(
+            self._repo_place = self._scheduler.call(
+                'get_organization', self._github.get_organization,
                 github_organization)
         else:
             self._repo_place = self._github.get_user()
 
+        self.__owner = self._scheduler.call(
+            'get_owner', lambda: self._repo_place.login)
+
+    def _create_github(self):
+        # Rate limits are handled by the scheduler, only retry requests
+        # that failed because of connection errors here
+        return Github(self.__github_token, per_page=100,
+                      retry=Retry(total=3, backoff_factor=1))
+
+    def __get_client(self):
+        try:
+            return self.__clients.get_nowait()
+        except Empty:
+            pass
+
+        client = self._create_github()
+        self._scheduler.register(client)
+        return client
+
     def _create_empty_repo(self, build):
-        repo = self._repo_place.create_repo(build.device)
-        repo.create_file('README', 'initial commit', build.device)
+        repo = self._scheduler.call('create_repo', self._repo_place.create_repo,
+                                    build.device)
+        self._scheduler.call('create_file', repo.create_file,
+                             'README', 'initial commit', build.device)
+        self.__repos[build.device] = repo
+        self.__releases[repo.full_name] = {}
         return repo
 
     def _find_repo(self, build):
+        with self.__cache_lock:
+            if build.device in self.__repos:
+                return self.__repos[build.device]
+
         try:
-            return self._repo_place.get_repo(build.device)
+            repo = self._scheduler.call('get_repo', self._repo_place.get_repo,
+                                        build.device)
+        except UnknownObjectException as e:
+            print(e)
+            repo = None
         except GithubException as e:
+            # Only remember the repositories that do not exist, the
+            # lookup is tried again after other errors
             print(e)
             return None
 
+        with self.__cache_lock:
+            self.__repos[build.device] = repo
+        return repo
+
     def _get_repo(self, build):
         repo = self._find_repo(build)
 
@@ -600,18 +1652,31 @@ class GithubPublisher(Publisher):
 
         return repo
 
-    def _get_release(self, repo, build):
-        release = None
+    def _get_releases(self, repo):
+        releases = self.__releases.get(repo.full_name)
+        if releases is not None:
+            return releases
+
+        releases = {}
         try:
-            release = repo.get_release(build.name)
+            for release in self._scheduler.call(
+                    'get_releases', lambda: list(repo.get_releases())):
+                releases[release.tag_name] = release
         except GithubException:
-            pass
-        return release
+            return releases
+
+        self.__releases[repo.full_name] = releases
+        return releases
+
+    def _get_release(self, repo, build):
+        return self._get_releases(repo).get(build.name)
 
     def _delete_release(self, repo, build):
         release = self._get_release(repo, build)
         if release is not None:
-            release.delete_release()
+            self._scheduler.call('delete_release', release.delete_release)
+            self._get_releases(repo).pop(build.name, None)
+            self.__assets.pop(release.id, None)
 
     def _create_empty_release(self, repo, build):
         try:
@@ -619,9 +1684,14 @@ class GithubPublisher(Publisher):
         except GithubException:
             pass
 
-        return repo.create_git_release(build.name, build.name, build.name)
+        release = self._scheduler.call('create_git_release', repo.create_git_release,
+                                       build.name, build.name, build.name)
+        self._get_releases(repo)[build.name] = release
+        return release
 
     def _unupload_build(self, build):
+        self.__upload_state.remove(build.files)
+
         repo = self._find_repo(build)
         if repo is None:
             return
@@ -631,6 +1701,75 @@ class GithubPublisher(Publisher):
         except GithubException:
             pass
 
+    def _unindex_build(self, builds, build):
+        super()._unindex_build(builds, build)
+        self.__upload_state.remove(build.files)
+
+    def _correct_build_file_sha256(self, build, file, sha256):
+        self.__upload_state.correct(file, sha256)
+        super()._correct_build_file_sha256(build, file, sha256)
+
+    def __unupload_device_builds(self, device, builds):
+        # The releases are looked up again through a client that is only
+        # used by this thread, so that they can be deleted concurrently
+        client = self.__get_client()
+
+        try:
+            try:
+                repo = self._scheduler.call_concurrent(
+                    'get_repo', client.get_repo, f'{self.__owner}/{device}')
+            except UnknownObjectException:
+                return [None] * len(builds)
+
+            releases = {}
+            for release in self._scheduler.call_concurrent(
+                    'get_releases', lambda: list(repo.get_releases())):
+                releases[release.tag_name] = release
+
+            errors = []
+            for build in builds:
+                release = releases.get(build.name)
+
+                try:
+                    if release is not None:
+                        self._scheduler.call_concurrent(
+                            'delete_release', release.delete_release)
+                except GithubException as e:
+                    errors.append(e)
+                    continue
+
+                errors.append(None)
+        finally:
+            self.__clients.put(client)
+
+        with self.__cache_lock:
+            cached_releases = self.__releases.get(repo.full_name)
+            if cached_releases is not None:
+                for build, error in zip(builds, errors):
+                    if error is None:
+                        cached_releases.pop(build.name, None)
+
+        return errors
+
+    def _unupload_builds(self, builds):
+        devices_builds = {}
+        for build in builds:
+            devices_builds.setdefault(build.device, []).append(build)
+
+        with ThreadPoolExecutor(self._delete_workers) as executor:
+            futures = {device: executor.submit(self.__unupload_device_builds,
+                                               device, device_builds)
+                       for device, device_builds in devices_builds.items()}
+
+            devices_errors = {}
+            for device, future in futures.items():
+                try:
+                    devices_errors[device] = iter(future.result())
+                except (GithubException, RequestException) as e:
+                    devices_errors[device] = iter([e] * len(devices_builds[device]))
+
+        return [next(devices_errors[build.device]) for build in builds]
+
     def _is_build_uploaded(self, build):
         repo = self._find_repo(build)
         if repo is None:
@@ -639,42 +1778,255 @@ class GithubPublisher(Publisher):
         release = self._get_release(repo, build)
         return release is not None
 
-    def _upload_file(self, release, file):
+    def __prefetch_device_releases(self, device):
+        client = self.__get_client()
+
         try:
-            self._remove_file(release, file)
-        except GithubException:
-            pass
+            try:
+                repo = self._scheduler.call_concurrent(
+                    'get_repo', client.get_repo, f'{self.__owner}/{device}')
+            except UnknownObjectException as e:
+                print(e)
+                repo = None
+
+            releases = None
+            if repo is not None:
+                try:
+                    releases = {}
+                    for release in self._scheduler.call_concurrent(
+                            'get_releases', lambda: list(repo.get_releases())):
+                        releases[release.tag_name] = release
+                except GithubException:
+                    releases = None
+        finally:
+            self.__clients.put(client)
+
+        with self.__cache_lock:
+            self.__repos[device] = repo
+            if releases is not None:
+                self.__releases[repo.full_name] = releases
+
+    def _are_builds_uploaded(self, builds):
+        # Look up the repositories and list the releases of all the
+        # devices concurrently, the checks are then answered from cache
+        with self.__cache_lock:
+            devices = {build.device for build in builds
+                       if build.device not in self.__repos}
+
+        with ThreadPoolExecutor(self._check_workers) as executor:
+            for future in [executor.submit(self.__prefetch_device_releases, device)
+                           for device in sorted(devices)]:
+                future.result()
+
+        return [self._is_build_uploaded(build) for build in builds]
+
+    def _is_file_uploaded(self, asset, file):
+        if asset.state != 'uploaded' or asset.size != file.size:
+            return False
+
+        # The asset digest is not known, trust it only if it was uploaded
+        # from a file with the same hash
+        entry = self.__upload_state.get(file)
+        return entry is not None and entry['asset_id'] == asset.id \
+            and entry['bytes_sent'] == file.size
+
+    def _upload_file(self, release, file, refresh=False):
+        asset = self._find_asset(release, file, refresh)
+
+        if asset is not None and self._is_file_uploaded(asset, file):
+            print(f'File {file.filename} is already uploaded, skipping')
+            file.url = asset.browser_download_url
+            return
+
+        # Release assets cannot be appended to, interrupted uploads have
+        # to be started over after removing the partial asset
+        entry = self.__upload_state.get(file)
+        if entry is not None and entry['asset_id'] is None:
+            print(f'Found interrupted upload of file {file.filename} '
+                  f'after {entry["bytes_sent"]}/{file.size} bytes, uploading again')
+
+        if asset is not None:
+            self._delete_asset(release, asset)
+
+        self.__upload_state.update(file, None, 0)
+
+        content_type = mimetypes.guess_type(file.path)[0] or 'application/octet-stream'
+        progress = None
 
-        asset = release.upload_asset(file.path)
+        def upload_asset():
+            nonlocal progress
+            with UploadProgress(file) as progress:
+                return release.upload_asset_from_memory(
+                    progress, file.size, file.filename, content_type)
+
+        try:
+            asset = self._scheduler.call_upload('upload_asset', upload_asset)
+        except BaseException:
+            if progress is not None:
+                self.__upload_state.update(file, None, progress.bytes_sent)
+            raise
+
+        self.__upload_state.update(file, asset.id, file.size)
+        self.__set_asset(release, asset)
+
+        metrics.add('uploaded_files')
+        metrics.add('uploaded_bytes', file.size)
+        metrics.add('upload_seconds', progress.elapsed)
+
+        print(f'Uploaded file {file.filename} in {format_duration(progress.elapsed)}, '
+              f'{progress.speed:.1f} MB/s')
 
         file.url = asset.browser_download_url
 
+    def _upload_file_retry(self, release, file):
+        attempt = 0
+
+        while True:
+            try:
+                # A failed upload can leave a partial asset behind that
+                # is not part of the release assets fetched earlier
+                self._upload_file(release, file, attempt != 0)
+                return
+            except (GithubException, RequestException) as e:
+                if attempt == self.__upload_retries:
+                    raise
+
+                attempt += 1
+                print(f'Failed to upload file {file.filename}, retrying ({attempt}/{self.__upload_retries}): {e}')
+                sleep(2 ** attempt)
+
+    def _upload_files(self, release, files):
+        with ThreadPoolExecutor(self.__upload_workers) as executor:
+            futures = [executor.submit(self._upload_file_retry, release, file)
+                       for file in files]
+
+            for future in futures:
+                future.result()
+
     def _upload_build_file(self, build, file):
+        self._upload_build_files(build, [file])
+
+    def _upload_build_files(self, build, files):
         repo = self._get_repo(build)
         release = self._get_release(repo, build)
 
-        self._upload_file(release, file)
+        self._upload_files(release, files)
 
-    def _remove_file(self, release, file):
-        try:
-            assets = release.assets
-        except AttributeError:
-            assets = release.get_assets()
+    def __release_assets(self, release, refresh=False):
+        with self.__cache_lock:
+            assets = self.__assets.get(release.id)
+
+        if assets is not None and not refresh:
+            return assets
+
+        if refresh:
+            listed_assets = None
+        else:
+            try:
+                listed_assets = release.assets
+            except AttributeError:
+                listed_assets = None
 
-        for asset in assets:
-            if asset.name == file.filename:
-                asset.delete_asset()
+        if listed_assets is None:
+            listed_assets = self._scheduler.call(
+                'get_assets', lambda: list(release.get_assets()))
+
+        assets = {asset.name: asset for asset in listed_assets}
+        with self.__cache_lock:
+            self.__assets[release.id] = assets
+
+        return assets
+
+    def __set_asset(self, release, asset, old_name=None):
+        with self.__cache_lock:
+            assets = self.__assets.get(release.id)
+            if assets is None:
+                return
+
+            if old_name is not None:
+                assets.pop(old_name, None)
+            assets[asset.name] = asset
+
+    def _delete_asset(self, release, asset):
+        self._scheduler.call('delete_asset', asset.delete_asset)
+
+        with self.__cache_lock:
+            assets = self.__assets.get(release.id)
+            if assets is not None and asset.name in assets \
+                    and assets[asset.name].id == asset.id:
+                del assets[asset.name]
+
+    def _get_assets(self, release, refresh=False):
+        assets = self.__release_assets(release, refresh)
+
+        with self.__cache_lock:
+            return list(assets.values())
+
+    def _find_asset(self, release, file, refresh=False):
+        assets = self.__release_assets(release, refresh)
+
+        with self.__cache_lock:
+            return assets.get(file.filename)
+
+    def _remove_file(self, release, file, refresh=False):
+        asset = self._find_asset(release, file, refresh)
+        if asset is not None:
+            self._delete_asset(release, asset)
 
     def _remove_build_file(self, build, file):
         repo = self._get_repo(build)
         release = self._get_release(repo, build)
         self._remove_file(release, file)
+        self.__upload_state.remove([file])
+
+    def _rename_build_file(self, build, existing_file, file):
+        repo = self._get_repo(build)
+        release = self._get_release(repo, build)
+
+        asset = self._find_asset(release, existing_file)
+        if asset is None:
+            self._upload_files(release, [file])
+            return
+
+        asset = self._scheduler.call('update_asset', asset.update_asset, file.filename)
+        self.__upload_state.remove([existing_file])
+        self.__upload_state.update(file, asset.id, file.size)
+        self.__set_asset(release, asset, existing_file.filename)
+        file.url = asset.browser_download_url
+
+    def _get_build_release(self, repo, build):
+        release = self._get_release(repo, build)
+        if release is None:
+            return self._create_empty_release(repo, build)
+
+        # Reuse the existing release so that files that are already
+        # uploaded do not have to be uploaded again, only remove the
+        # assets that are not part of the build anymore
+        filenames = {file.filename for file in build.files}
+        for asset in self._get_assets(release):
+            if asset.name not in filenames:
+                self._delete_asset(release, asset)
+
+        return release
 
     def _upload_build(self, build):
         repo = self._get_repo(build)
-        release = self._create_empty_release(repo, build)
+        release = self._get_build_release(repo, build)
 
         for file in build.files:
             print(f'Uploading file {file.filename}')
-            self._upload_file(release, file)
-            print(f'Uploaded file {file.filename}')
+
+        self._upload_files(release, build.files)
+
+    def reset(self):
+        super().reset()
+
+        # Releases can be changed by others between jobs
+        with self.__cache_lock:
+            self.__repos = {}
+            self.__releases = {}
+            self.__assets = {}
+
+    def print_stats(self):
+        super().print_stats()
+        self._scheduler.print_stats()
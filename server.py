@@ -0,0 +1,162 @@
+import json
+import os
+import time
+
+from contextlib import ExitStack
+
+from file_utils import path_join, write_file_atomic
+
+
+def submit_job(spool_path, job):
+    # Jobs are written atomically, the server never reads one that is
+    # only partially written, and their names keep them in order
+    os.makedirs(spool_path, exist_ok=True)
+    name = f'{time.time_ns()}-{os.getpid()}.json'
+    write_file_atomic(path_join(spool_path, name), json.dumps(job))
+    return name
+
+
+def coalesce_jobs(jobs):
+    # Consecutive index jobs are merged, each device is indexed once no
+    # matter how many jobs were queued for it, and indexing all devices
+    # replaces any other index job, deletions are kept in order
+    batches = []
+
+    for job in jobs:
+        command = job.get('command')
+
+        if command == 'index':
+            if not batches or batches[-1]['command'] != 'index':
+                batches.append({
+                    'command': 'index',
+                    'all': False,
+                    'changed': True,
+                    'devices': [],
+                    'builds': [],
+                })
+
+            batch = batches[-1]
+            if job.get('build'):
+                if job['build'] not in batch['builds']:
+                    batch['builds'].append(job['build'])
+            elif job.get('model'):
+                if job['model'] not in batch['devices']:
+                    batch['devices'].append(job['model'])
+            else:
+                batch['all'] = True
+                batch['changed'] = batch['changed'] and job.get('changed', False)
+        elif command == 'delete':
+            if not batches or batches[-1] != job:
+                batches.append(job)
+        else:
+            print(f'Skipping job with unknown command {command}')
+
+    # Indexing only the changed devices would skip the devices and builds
+    # that were explicitly asked for if they did not change
+    for batch in batches:
+        if batch['command'] == 'index' and (batch['devices'] or batch['builds']):
+            batch['changed'] = False
+
+    return batches
+
+
+class Server:
+    def __init__(self, publishers, spool_path, interval=1):
+        self.__publishers = publishers
+        self.__spool_path = spool_path
+        self.__interval = interval
+
+    def __read_jobs(self):
+        names = sorted(name for name in os.listdir(self.__spool_path)
+                       if name.endswith('.json') and not name.startswith('.'))
+
+        paths = []
+        jobs = []
+        for name in names:
+            path = path_join(self.__spool_path, name)
+
+            try:
+                with open(path, 'r') as job_file:
+                    jobs.append(json.load(job_file))
+            except (IOError, ValueError) as e:
+                print(f'Skipping invalid job {name}: {e}')
+                os.remove(path)
+                continue
+
+            paths.append(path)
+
+        return paths, jobs
+
+    @staticmethod
+    def __run_index(publisher, batch):
+        if batch['all']:
+            publisher.index_builds(batch['changed'])
+            return
+
+        for device in batch['devices']:
+            publisher.index_device_builds(device)
+
+        for build in batch['builds']:
+            publisher.index_build(build)
+
+    @staticmethod
+    def __run_delete(publisher, job):
+        if job.get('all'):
+            builds = publisher.find_all_builds()
+        else:
+            builds = publisher.find_builds(device=job.get('model'), version=job.get('version'),
+                                           min_date=job.get('start_date'),
+                                           max_date=job.get('end_date'),
+                                           date=job.get('date'))
+
+        if builds:
+            publisher.delete_builds(builds)
+        else:
+            print('No builds found')
+
+    def __run_batch(self, batch):
+        for publisher in self.__publishers:
+            try:
+                if batch['command'] == 'index':
+                    self.__run_index(publisher, batch)
+                else:
+                    self.__run_delete(publisher, batch)
+            except Exception as e:
+                print(f'Failed to run {batch["command"]} job: {e}')
+
+            # Jobs are run one at a time, and their changes are written
+            # before the next one starts
+            publisher.flush()
+            publisher.reset()
+            publisher.print_stats()
+
+            print()
+
+    def run(self):
+        os.makedirs(self.__spool_path, exist_ok=True)
+
+        with ExitStack() as stack:
+            # Keep the builds, indexes and clients loaded between jobs
+            for publisher in self.__publishers:
+                stack.enter_context(publisher.session())
+
+            print(f'Waiting for jobs in {self.__spool_path}')
+
+            while True:
+                paths, jobs = self.__read_jobs()
+                if not jobs:
+                    time.sleep(self.__interval)
+                    continue
+
+                batches = coalesce_jobs(jobs)
+                print(f'Running {len(batches)} jobs out of {len(jobs)} queued')
+
+                for batch in batches:
+                    self.__run_batch(batch)
+
+                # Jobs are only removed once they have run, the ones that
+                # were running when the server stopped are run again when
+                # it starts, jobs queued from now on are picked up by the
+                # next round
+                for path in paths:
+                    os.remove(path)
@@ -0,0 +1,103 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from publisher import LocalPublisher
+
+
+def create_build(builds_path, device, date):
+    device_path = os.path.join(builds_path, device)
+    os.makedirs(device_path, exist_ok=True)
+
+    name = f'lineage-21.0-{date}-UNOFFICIAL-{device}.zip'
+    with open(os.path.join(device_path, name), 'wb') as build_file:
+        build_file.write(os.urandom(1024))
+
+
+class PublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.__temp_dir = tempfile.TemporaryDirectory()
+        self.temp_path = self.__temp_dir.name
+        self.builds_path = os.path.join(self.temp_path, 'builds')
+
+        create_build(self.builds_path, 'bacon', '20240101')
+        create_build(self.builds_path, 'bardock', '20240101')
+
+    def tearDown(self):
+        self.__temp_dir.cleanup()
+
+    def create_publisher(self, name, blacklisted_devices=(), **kwargs):
+        return LocalPublisher(os.path.join(self.temp_path, f'{name}.json'), self.builds_path,
+                              list(blacklisted_devices), [], 0, **kwargs)
+
+    @staticmethod
+    def run_quietly(fn, *args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            fn(*args, **kwargs)
+        return output.getvalue()
+
+    def test_shared_hash_cache_keeps_blacklisted_devices(self):
+        hash_cache_path = os.path.join(self.temp_path, 'hash_cache.json')
+        publisher = self.create_publisher('all', hash_cache_path=hash_cache_path)
+        blacklisting_publisher = self.create_publisher(
+            'blacklisting', ['bacon'], hash_cache_path=hash_cache_path)
+
+        self.run_quietly(publisher.index_builds)
+        self.run_quietly(blacklisting_publisher.index_builds)
+
+        with open(hash_cache_path, 'r') as hash_cache_file:
+            paths = list(json.load(hash_cache_file))
+
+        self.assertEqual(sorted(os.path.basename(os.path.dirname(path)) for path in paths),
+                         ['bacon', 'bardock'])
+
+    def test_builds_index_matches_builds_json_written_after_flush(self):
+        publisher = self.create_publisher(
+            'builds', builds_index_path=os.path.join(self.temp_path, 'builds_index.json'))
+
+        with publisher.session():
+            self.run_quietly(publisher.index_builds)
+            publisher.flush()
+
+            # Change the builds json without changing what is indexed
+            file = publisher.find_all_builds()[0].files[0]
+            file.url = file.url.upper()
+            self.run_quietly(publisher.index_builds, True)
+
+        output = self.run_quietly(publisher.index_builds, True)
+
+        self.assertNotIn('out of date', output)
+        self.assertIn('Found 0 changed devices, 2 unchanged', output)
+
+    def test_changed_index_does_not_count_blacklisted_devices(self):
+        publisher = self.create_publisher(
+            'builds', ['bacon'], builds_index_path=os.path.join(self.temp_path, 'builds_index.json'))
+
+        self.run_quietly(publisher.index_builds)
+        output = self.run_quietly(publisher.index_builds, True)
+
+        self.assertIn('Found 0 changed devices, 1 unchanged', output)
+
+    def test_shared_hash_cache_stats_are_per_run(self):
+        hash_cache_path = os.path.join(self.temp_path, 'hash_cache.json')
+        publisher = self.create_publisher('first', hash_cache_path=hash_cache_path)
+        other_publisher = self.create_publisher('second', hash_cache_path=hash_cache_path)
+
+        self.run_quietly(publisher.index_builds)
+        self.run_quietly(publisher.print_stats)
+        self.run_quietly(other_publisher.index_builds)
+
+        self.assertEqual(self.run_quietly(other_publisher.print_stats),
+                         'Hash cache | Hits: 2, Misses: 0\n')
+
+        self.run_quietly(publisher.index_builds)
+
+        self.assertEqual(self.run_quietly(publisher.print_stats),
+                         'Hash cache | Hits: 2, Misses: 0\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+
+from server import coalesce_jobs
+
+
+class CoalesceJobsTest(unittest.TestCase):
+    def test_index_jobs_are_merged(self):
+        batches = coalesce_jobs([
+            {'command': 'index', 'model': 'bacon'},
+            {'command': 'index', 'model': 'bacon'},
+            {'command': 'index', 'build': '/builds/bardock/build.zip'},
+        ])
+
+        self.assertEqual(batches, [{
+            'command': 'index',
+            'all': False,
+            'changed': False,
+            'devices': ['bacon'],
+            'builds': ['/builds/bardock/build.zip'],
+        }])
+
+    def test_changed_index_keeps_explicit_devices(self):
+        batches = coalesce_jobs([
+            {'command': 'index', 'changed': True},
+            {'command': 'index', 'model': 'bacon'},
+        ])
+
+        self.assertEqual(len(batches), 1)
+        self.assertTrue(batches[0]['all'])
+        self.assertFalse(batches[0]['changed'])
+
+    def test_changed_index_jobs_stay_changed(self):
+        batches = coalesce_jobs([
+            {'command': 'index', 'changed': True},
+            {'command': 'index', 'changed': True},
+        ])
+
+        self.assertEqual(len(batches), 1)
+        self.assertTrue(batches[0]['all'])
+        self.assertTrue(batches[0]['changed'])
+
+    def test_deletions_split_index_jobs(self):
+        delete_job = {'command': 'delete', 'model': 'bacon'}
+        batches = coalesce_jobs([
+            {'command': 'index', 'model': 'bacon'},
+            delete_job,
+            delete_job,
+            {'command': 'index', 'model': 'bacon'},
+        ])
+
+        self.assertEqual([batch['command'] for batch in batches], ['index', 'delete', 'index'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+
+from file_utils import MIB, write_file_atomic
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f'{hours}h{minutes:02}m{seconds:02}s'
+    return f'{minutes}m{seconds:02}s'
+
+
+class UploadState:
+    def __init__(self, path):
+        self.__path = path
+        self.__entries = None
+        self.__lock = threading.Lock()
+
+    def __load(self):
+        if self.__entries is not None:
+            return
+
+        if self.__path is None:
+            self.__entries = {}
+            return
+
+        try:
+            with open(self.__path, 'r') as upload_state_file:
+                self.__entries = json.load(upload_state_file)
+        except (IOError, ValueError):
+            self.__entries = {}
+
+    def __save(self):
+        if self.__path is None:
+            return
+
+        write_file_atomic(self.__path, json.dumps(self.__entries))
+
+    def get(self, file):
+        with self.__lock:
+            self.__load()
+
+            entry = self.__entries.get(file.path)
+            if entry is None or entry['sha256'] != file.sha256 \
+                    or entry['size'] != file.size:
+                return None
+
+            return dict(entry)
+
+    def update(self, file, asset_id, bytes_sent):
+        with self.__lock:
+            self.__load()
+
+            self.__entries[file.path] = {
+                'sha256': file.sha256,
+                'size': file.size,
+                'asset_id': asset_id,
+                'bytes_sent': bytes_sent,
+            }
+
+            self.__save()
+
+    def correct(self, file, sha256):
+        # The file was uploaded as it is, only the hash it was recorded
+        # with was wrong
+        with self.__lock:
+            self.__load()
+
+            entry = self.__entries.get(file.path)
+            if entry is None or entry['sha256'] != file.sha256:
+                return
+
+            entry['sha256'] = sha256
+            self.__save()
+
+    def remove(self, files):
+        # Files that are not indexed anymore do not need their uploads
+        # to be resumed
+        with self.__lock:
+            self.__load()
+
+            removed = False
+            for file in files:
+                if self.__entries.pop(file.path, None) is not None:
+                    removed = True
+
+            if removed:
+                self.__save()
+
+
+class UploadProgress:
+    def __init__(self, file, interval=10):
+        self.__file = file
+        self.__interval = interval
+        self.__fd = None
+        self.__start_time = None
+        self.__last_print_time = None
+        self.bytes_sent = 0
+
+    def __enter__(self):
+        self.__fd = open(self.__file.path, 'rb')
+        self.__start_time = time.monotonic()
+        self.__last_print_time = self.__start_time
+        self.bytes_sent = 0
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.__fd.close()
+        return False
+
+    def __len__(self):
+        return self.__file.size
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.__start_time
+
+    @property
+    def speed(self):
+        elapsed = self.elapsed
+        if elapsed == 0:
+            return 0
+        return self.bytes_sent / MIB / elapsed
+
+    def __print_progress(self):
+        size = self.__file.size
+        speed = self.speed
+        percent = self.bytes_sent * 100 // size if size else 100
+
+        eta = ''
+        if speed > 0:
+            eta = f', ETA {format_duration((size - self.bytes_sent) / MIB / speed)}'
+
+        print(f'Uploading file {self.__file.filename}: {percent}% '
+              f'({self.bytes_sent // MIB}/{size // MIB} MB), {speed:.1f} MB/s{eta}')
+
+    def read(self, size=-1):
+        data = self.__fd.read(size)
+        self.bytes_sent += len(data)
+
+        now = time.monotonic()
+        if now - self.__last_print_time >= self.__interval:
+            self.__last_print_time = now
+            self.__print_progress()
+
+        return data
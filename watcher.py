@@ -0,0 +1,147 @@
+import os
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from file_utils import path_dirs, path_filename, path_join
+
+
+class Watcher:
+    def __init__(self, publishers, interval=60, settle=30):
+        self.__publishers = publishers
+        self.__interval = interval
+        self.__settle = settle
+
+        # Publishers indexing the same builds path share its watches
+        self.__roots = {}
+        for publisher in publishers:
+            root = os.path.realpath(publisher.builds_path)
+            self.__roots.setdefault(root, []).append(publisher)
+
+        self.__inotify = None
+        self.__watches = {}
+        self.__pending = {}
+
+    def __index_changed(self):
+        for publisher in self.__publishers:
+            # Releases can be changed by others between runs, look them
+            # up again every time
+            publisher.reset()
+            publisher.index_builds(changed=True)
+            publisher.print_stats()
+            print()
+
+    def __index_device(self, root, device):
+        # Removed devices are only cleaned up when indexing all of them
+        if not os.path.isdir(path_join(root, device)):
+            for publisher in self.__roots[root]:
+                publisher.reset()
+                publisher.index_builds(changed=True)
+                publisher.print_stats()
+                print()
+            return
+
+        for publisher in self.__roots[root]:
+            publisher.reset()
+
+            # Devices are skipped if they did not change, like after the
+            # events caused by the publisher removing builds
+            publisher.index_device_builds(device, changed=True)
+            publisher.print_stats()
+            print()
+
+    def __poll(self):
+        while True:
+            self.__index_changed()
+            time.sleep(self.__interval)
+
+    def __add_watch(self, path, root, device):
+        mask = flags.CREATE | flags.DELETE | flags.MOVED_TO | flags.MOVED_FROM | \
+            flags.CLOSE_WRITE | flags.DELETE_SELF
+
+        try:
+            wd = self.__inotify.add_watch(path, mask)
+        except OSError as e:
+            print(f'Failed to watch {path}: {e}')
+            return
+
+        self.__watches[wd] = (path, root, device)
+
+    def __add_device_watches(self, device_path, root):
+        device = path_filename(device_path)
+        self.__add_watch(device_path, root, device)
+
+        # Builds can also be directories holding the rom and extra files
+        for build_path in path_dirs(device_path):
+            self.__add_watch(build_path, root, device)
+
+    def __handle_event(self, event):
+        watch = self.__watches.get(event.wd)
+        if watch is None:
+            return
+
+        if event.mask & flags.IGNORED:
+            del self.__watches[event.wd]
+            return
+
+        path, root, device = watch
+        created_dir = event.mask & flags.ISDIR and \
+            event.mask & (flags.CREATE | flags.MOVED_TO)
+
+        if device is None:
+            # Only new device directories matter inside the builds path
+            if not created_dir:
+                return
+
+            device = event.name
+            self.__add_device_watches(path_join(path, device), root)
+        elif created_dir and path_filename(path) == device:
+            self.__add_watch(path_join(path, event.name), root, device)
+
+        # Wait for uploads to settle before indexing the device
+        self.__pending[(root, device)] = time.monotonic()
+
+    def __index_settled_devices(self):
+        now = time.monotonic()
+
+        for (root, device), last_event_time in list(self.__pending.items()):
+            if now - last_event_time < self.__settle:
+                continue
+
+            del self.__pending[(root, device)]
+
+            try:
+                self.__index_device(root, device)
+            except Exception as e:
+                print(f'Failed to index device {device}, retrying later: {e}')
+                self.__pending[(root, device)] = time.monotonic()
+
+    def __watch(self):
+        self.__inotify = INotify()
+
+        for root in self.__roots:
+            self.__add_watch(root, root, None)
+
+            for device_path in path_dirs(root):
+                self.__add_device_watches(device_path, root)
+
+        # Catch up with the changes made while nothing was watching
+        self.__index_changed()
+
+        print(f'Watching {", ".join(self.__roots)} for new builds')
+
+        while True:
+            for event in self.__inotify.read(timeout=1000):
+                self.__handle_event(event)
+
+            self.__index_settled_devices()
+
+    def run(self):
+        if INotify is None:
+            print(f'inotify_simple is not installed, checking for changes every {self.__interval}s')
+            self.__poll()
+        else:
+            self.__watch()